@@ -0,0 +1,103 @@
+"""
+Microbenchmark for NeuralNetworkAgent action selection: the old sort and
+linear legal-action scan against the precomputed index and NumPy mask.
+Both paths are checked to pick the same action on every decision.
+
+    python benchmarks/agent_action.py models/converter.pkl --states decisions.pkl
+
+--states takes a pickled list of (gamestate, legal_actions, initial)
+tuples recorded from live play. Probabilities come from --model when
+given, otherwise from a seeded Dirichlet draw per decision. Without
+--states, random legal action sets are sampled from the converter.
+"""
+import os
+import sys
+import time
+import random
+import cPickle as pickle
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from showdown_client import NeuralNetworkAgent
+from showdown_client.bundle import build_net
+
+def parse_args():
+    argparser = ArgumentParser()
+    argparser.add_argument('converter')
+    argparser.add_argument('--model')
+    argparser.add_argument('--states')
+    argparser.add_argument('--decisions', type=int, default=1000)
+    argparser.add_argument('--seed', type=int, default=0)
+
+    return argparser.parse_args()
+
+def legacy_select(probs, actions, legal_actions, initial):
+    best = sorted(zip(probs.tolist(), actions), key=lambda x: -x[0])
+    for prob, action in best:
+        if initial and action.is_move():
+            return action
+        if action in legal_actions:
+            return action
+
+def load_net(converter, model):
+    net = build_net(converter)
+    with open(model) as fp:
+        net.set_state(pickle.load(fp))
+    return net
+
+def recorded_decisions(args, converter, rng):
+    with open(args.states) as fp:
+        decisions = pickle.load(fp)
+    net = load_net(converter, args.model) if args.model else None
+    for state, legal_actions, initial in decisions:
+        if net is not None:
+            probs = net.predict(converter.encode_state(state)[None])[0]
+        else:
+            probs = rng.dirichlet(np.ones(converter.get_output_dimension()))
+        yield probs, legal_actions, initial
+
+def sampled_decisions(args, actions, rng):
+    moves = [action for action in actions if action.is_move()]
+    switches = [action for action in actions if action.is_switch()]
+    for i in xrange(args.decisions):
+        initial = i % 50 == 0
+        if initial:
+            legal_actions = random.sample(switches, 6)
+        else:
+            legal_actions = random.sample(moves, 4) + random.sample(switches, random.randint(0, 5))
+        yield rng.dirichlet(np.ones(len(actions))), legal_actions, initial
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+
+    with open(args.converter) as fp:
+        converter = pickle.load(fp)
+    agent = NeuralNetworkAgent(None, converter)
+    actions = converter.get_actions()
+
+    if args.states:
+        decisions = list(recorded_decisions(args, converter, rng))
+    else:
+        decisions = list(sampled_decisions(args, actions, rng))
+
+    legacy_time, masked_time = 0.0, 0.0
+    for probs, legal_actions, initial in decisions:
+        start = time.time()
+        expected = legacy_select(probs, actions, legal_actions, initial)
+        legacy_time += time.time() - start
+
+        start = time.time()
+        index = agent.select_action(probs, legal_actions, initial=initial)
+        masked_time += time.time() - start
+
+        chosen = agent.actions[index] if index is not None else None
+        assert chosen == expected, "Selection mismatch: %s != %s" % (chosen, expected)
+
+    print "%u decisions, identical choices" % len(decisions)
+    print "  legacy  %8.1fus/decision" % (legacy_time / len(decisions) * 1e6)
+    print "  masked  %8.1fus/decision" % (masked_time / len(decisions) * 1e6)
@@ -0,0 +1,206 @@
+"""
+End-to-end benchmark: plays full battles against the local fake server
+(benchmarks/fake_server.py) and reports turns per second, per-turn latency
+percentiles and memory per bot. Needs no network access.
+
+    python benchmarks/battle.py --backend websocket --battles 20 --bots 4
+    python benchmarks/battle.py --backend websocket --battles 20 --bots 16 --event-loop
+    python benchmarks/battle.py --backend selenium --browser phantomjs --battles 3
+
+The agent picks random legal actions unless --model is given, so the
+numbers measure the client rather than the network.
+"""
+import os
+import sys
+import json
+import logging
+import threading
+import cPickle as pickle
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from showdown_client import (ShowdownClient, ProtocolClient, NeuralNetworkAgent, RandomAgent,
+                             BattleOrchestrator, Metrics, SessionPool, ReplayArchiver)
+from showdown_client.bundle import build_net, load_bundle, is_bundle
+from showdown_client.memory import rss_kb, tree_rss_kb
+from fake_server import FakeShowdownServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+BENCHMARK_BUCKETS = [0.1, 0.2, 0.5, 1, 1.5, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300,
+                     500, 750, 1000, 2000, 5000, 10000, 30000, 60000]
+
+REPORTED = ['turn_ms', 'get_gamestate_ms', 'get_legal_actions_ms', 'get_action_ms', 'perform_action_ms',
+            'reaction_latency_ms', 'wake_latency_ms']
+
+def parse_args():
+    argparser = ArgumentParser()
+    argparser.add_argument('--backend', default='websocket', choices=['selenium', 'websocket'])
+    argparser.add_argument('--browser', default='phantomjs')
+    argparser.add_argument('--battles', type=int, default=10)
+    argparser.add_argument('--bots', type=int, default=1)
+    argparser.add_argument('--pool', action='store_true')
+    argparser.add_argument('--event-loop', action='store_true')
+    argparser.add_argument('--loop-threads', type=int, default=4)
+    argparser.add_argument('--recycle-battles', type=int, default=50)
+    argparser.add_argument('--team', default=os.path.join(ROOT, 'teams', 'lopunny.txt'))
+    argparser.add_argument('--opponent-team', default=os.path.join(ROOT, 'teams', 'gallade.txt'))
+    argparser.add_argument('--opponent-delay-ms', type=float, default=0.0)
+    argparser.add_argument('--archive-dir')
+    argparser.add_argument('--model')
+    argparser.add_argument('--converter')
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--json', action='store_true')
+
+    return argparser.parse_args()
+
+class MemorySampler(object):
+    """
+    Samples the RSS of this process and of every browser process tree
+    until stopped and keeps the peaks.
+    """
+
+    def __init__(self, clients, interval=0.5):
+        self.clients = clients
+        self.interval = interval
+        self.peak_python = 0
+        self.peak_browsers = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def sample(self):
+        self.peak_python = max(self.peak_python, rss_kb(os.getpid()))
+        pids = [client.get_browser_pid() for client in list(self.clients) if hasattr(client, 'get_browser_pid')]
+        self.peak_browsers = max(self.peak_browsers, sum(tree_rss_kb(pid) for pid in pids if pid is not None))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+def load_agent(args):
+    if args.model is None:
+        return RandomAgent(seed=args.seed)
+    if is_bundle(args.model):
+        weights, converter = load_bundle(args.model)
+    else:
+        with open(args.converter) as fp:
+            converter = pickle.load(fp)
+        with open(args.model) as fp:
+            weights = pickle.load(fp)
+    net = build_net(converter)
+    net.set_state(weights)
+    return NeuralNetworkAgent(net, converter)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args()
+    if args.pool and args.backend != 'selenium':
+        raise ValueError("--pool only applies to the selenium backend")
+    if args.event_loop and args.pool:
+        raise ValueError("--event-loop does not apply with --pool")
+
+    with open(args.team) as fp:
+        team_text = fp.read()
+    with open(args.opponent_team) as fp:
+        opponent_text = fp.read()
+
+    server = FakeShowdownServer(team_text, opponent_text, seed=args.seed,
+                                opponent_delay=args.opponent_delay_ms / 1000.0)
+    server.start()
+
+    agent = load_agent(args)
+    metrics = Metrics()
+    for name in REPORTED:
+        metrics.histogram(name, BENCHMARK_BUCKETS)
+    clients = []
+    sampler = MemorySampler(clients)
+    archiver = None
+    if args.archive_dir:
+        archiver = ReplayArchiver(args.archive_dir, metrics=metrics)
+        archiver.start()
+
+    def create_client(index):
+        if args.backend == 'websocket':
+            client = ProtocolClient(agent, url=server.websocket_url, login_url=server.login_url, metrics=metrics,
+                                    archiver=archiver, replay_url=server.replay_url)
+        else:
+            client = ShowdownClient(agent, browser=args.browser, url=server.url, metrics=metrics, archiver=archiver)
+        clients.append(client)
+        return client
+
+    def setup(client, index, warm=False):
+        client.choose_name('benchbot%u' % index)
+        if not warm:
+            client.mute()
+            client.teambuilder()
+            client.create_team(team_text, 'benchmark')
+            client.home()
+        client.select_battle_format('ou')
+
+    def make_client(index):
+        client = create_client(index)
+        client.start()
+        setup(client, index)
+        return client
+
+    pool = None
+    if args.pool:
+        pool = SessionPool(create_client, setup, size=args.bots, max_battles=args.recycle_battles)
+        pool.start()
+    sampler.start()
+    if args.event_loop:
+        from showdown_client.aio import run_battles
+        loop_clients = [make_client(i) for i in xrange(args.bots)]
+        summary = run_battles(loop_clients, args.battles, threads=args.loop_threads)
+        for client in loop_clients:
+            if client.get_state() != 'stopped':
+                client.stop()
+    else:
+        summary = BattleOrchestrator(make_client, concurrency=args.bots, pool=pool).run(args.battles)
+    if pool is not None:
+        pool.stop()
+    sampler.stop()
+    if archiver is not None:
+        archiver.stop()
+    server.stop()
+
+    bots = max(1, min(args.bots, args.battles))
+    turns = metrics.histogram('turn_ms').count
+    report = {
+        'backend': args.backend,
+        'bots': bots,
+        'battles': summary['battles'],
+        'failed': summary['failed'],
+        'elapsed': summary['elapsed'],
+        'turns': turns,
+        'turns_per_sec': turns / summary['elapsed'] if summary['elapsed'] > 0 else 0.0,
+        'driver_calls_per_turn': metrics.histogram('turn_driver_calls').mean(),
+        'python_rss_mb': sampler.peak_python / 1024.0,
+        'browser_rss_mb': sampler.peak_browsers / 1024.0,
+        'rss_per_bot_mb': (sampler.peak_python + sampler.peak_browsers) / 1024.0 / bots,
+        'latency_ms': dict((name, metrics.histogram(name).summary()) for name in REPORTED),
+    }
+
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print "%s: %u battles (%u failed) with %u bots in %.1fs" % (args.backend, report['battles'],
+                                                                 report['failed'], bots, report['elapsed'])
+        print "  %u turns, %.1f turns/sec, %.1f driver calls/turn" % (turns, report['turns_per_sec'],
+                                                                   report['driver_calls_per_turn'] or 0.0)
+        print "  memory: %.1fMB python, %.1fMB browsers, %.1fMB per bot" % (report['python_rss_mb'],
+                                                                          report['browser_rss_mb'],
+                                                                          report['rss_per_bot_mb'])
+        for name in REPORTED:
+            print "  %-22s %s" % (name, metrics.histogram(name))
@@ -0,0 +1,363 @@
+"""
+A local stand-in for Showdown. One HTTP port serves:
+
+    /                       a fake client page with the DOM ShowdownClient scrapes
+    /action.php             login assertions and replay uploads
+    /showdown/websocket     the sim protocol, for the page and for ProtocolClient
+
+Every /search starts a battle in the local simulator against a scripted
+opponent. Battles are seeded, so the same seed replays the same protocol
+stream for the same choices.
+
+    python benchmarks/fake_server.py teams/lopunny.txt teams/gallade.txt --port 8000
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import struct
+import hashlib
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from showdown_client.sim import Battle
+from showdown_client.team import parse_team, to_id
+
+TURN_TIME = 150
+TOTAL_TIME = 300
+
+PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_client.html')
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_TEXT, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x8, 0x9, 0xa
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+def read_exactly(fp, n):
+    data = fp.read(n)
+    if len(data) < n:
+        raise EOFError("Connection closed")
+    return data
+
+def read_frame(fp):
+    """
+    Reads one RFC 6455 frame and returns (opcode, payload). Fragmented
+    messages are not supported; neither client sends them.
+    """
+    head = bytearray(read_exactly(fp, 2))
+    opcode = head[0] & 0x0f
+    length = head[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', read_exactly(fp, 2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', read_exactly(fp, 8))[0]
+    mask = bytearray(read_exactly(fp, 4)) if head[1] & 0x80 else None
+    payload = bytearray(read_exactly(fp, length))
+    if mask is not None:
+        for i in xrange(length):
+            payload[i] ^= mask[i % 4]
+    return opcode, str(payload)
+
+def write_frame(fp, payload, opcode=OP_TEXT):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    fp.write(header + payload)
+    fp.flush()
+
+class RandomOpponent(object):
+    """
+    Scripted opponent: attacks with a random move and only switches when
+    forced to.
+    """
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def __call__(self, battle, side):
+        choices = battle.legal_choices(side)
+        moves = [choice for choice in choices if choice.startswith('move')]
+        return self.rng.choice(moves or choices)
+
+class FakeSession(object):
+    """
+    The server side of one websocket connection.
+    """
+
+    def __init__(self, server, send):
+        self.server = server
+        self.send = send
+        self.username = None
+        self.room_id = None
+        self.battle = None
+        self.opponent = None
+        self.timer = False
+        self.log = []
+
+    def send_room(self, lines):
+        self.send('>%s\n%s' % (self.room_id, '\n'.join(lines)))
+
+    def open(self):
+        self.send('|challstr|4|%s' % self.server.challenge)
+
+    def handle(self, message):
+        room_id, _, text = message.partition('|')
+        if text.startswith('/trn '):
+            self.username = text[len('/trn '):].split(',')[0]
+            self.send('|updateuser|%s|1|1' % self.username)
+        elif text.startswith('/search'):
+            self.start_battle(text[len('/search'):].strip() or 'ou')
+        elif text.startswith('/leave '):
+            room_id = text[len('/leave '):].strip()
+            self.send('>%s\n|deinit' % room_id)
+            if room_id == self.room_id:
+                self.battle, self.room_id = None, None
+        elif self.battle is None or room_id != self.room_id:
+            pass
+        elif text.startswith('/choose '):
+            self.choose(text[len('/choose '):].split('|')[0])
+        elif text.startswith('/timer'):
+            self.timer = True
+            self.send_room(["|inactive|Battle timer is ON: inactive players will automatically lose when time's up."])
+        elif text.startswith('/savereplay'):
+            self.send('|queryresponse|savereplay|%s' % json.dumps({
+                'log': '\n'.join(self.log),
+                'id': self.room_id[len('battle-'):],
+            }))
+        elif not text.startswith('/'):
+            self.send_room(['|c|%s|%s' % (self.username, text)])
+
+    def start_battle(self, battle_format):
+        index = self.server.next_battle()
+        self.room_id = 'battle-%s-%u' % (to_id(battle_format), index)
+        self.battle = Battle([parse_team(self.server.team), parse_team(self.server.opponent_team)],
+                             names=(self.username or 'guest', 'opponent'),
+                             seed=self.server.seed + index)
+        self.opponent = self.server.opponent_factory(self.server.seed + index)
+        self.timer = False
+        lines = self.battle.start()
+        self.send_room(lines[:1] + ['|title|%s vs. opponent' % self.username])
+        self.send_room([self.battle.request_line(0)])
+        self.send_room(lines[1:])
+        self.log = list(lines)
+        self.advance()
+
+    def choose(self, choice):
+        try:
+            self.battle.choose(0, choice)
+        except ValueError as e:
+            self.send_room(['|error|[Invalid choice] %s' % e])
+            return
+        self.advance()
+
+    def advance(self):
+        battle = self.battle
+        while not battle.ended:
+            if battle.pending[1] and battle.sides[1].choice is None:
+                battle.choose(1, self.opponent(battle, 1))
+            if not battle.ready():
+                break
+            if self.server.opponent_delay:
+                time.sleep(self.server.opponent_delay)
+            lines = battle.step()
+            self.log.extend(lines)
+            if not battle.ended:
+                self.send_room([battle.request_line(0)])
+            if self.timer and not battle.ended:
+                lines.append('|inactive|Time left: %u sec this turn | %u sec total' % (TURN_TIME, TOTAL_TIME))
+            self.send_room(lines)
+
+class FakeShowdownHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path)
+        if self.headers.get('Upgrade', '').lower() == 'websocket':
+            self.websocket()
+        elif path.path == '/action.php':
+            self.respond('text/plain', self.server.fake.assertion(urlparse.parse_qs(path.query)))
+        else:
+            self.respond('text/html; charset=utf-8', self.server.fake.page)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = urlparse.parse_qs(self.rfile.read(length))
+        if urlparse.parse_qs(urlparse.urlparse(self.path).query).get('act') == ['uploadreplay']:
+            self.server.fake.upload_replay(params)
+            self.respond('text/plain', 'success')
+            return
+        response = {'actionsuccess': True, 'assertion': self.server.fake.assertion(params)}
+        self.respond('text/plain', ']' + json.dumps(response))
+
+    def respond(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def websocket(self):
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept_key(self.headers['Sec-WebSocket-Key']))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = 1
+
+        send = lambda message: write_frame(self.wfile, message.encode('utf-8') if isinstance(message, unicode) else message)
+        session = FakeSession(self.server.fake, send)
+        session.open()
+        while True:
+            try:
+                opcode, payload = read_frame(self.rfile)
+            except (EOFError, socket.error):
+                break
+            if opcode == OP_CLOSE:
+                try:
+                    write_frame(self.wfile, payload[:2], OP_CLOSE)
+                except socket.error:
+                    pass
+                break
+            elif opcode == OP_PING:
+                write_frame(self.wfile, payload, OP_PONG)
+            elif opcode == OP_TEXT:
+                try:
+                    session.handle(payload.decode('utf-8'))
+                except socket.error:
+                    break
+
+    def log_message(self, format, *args):
+        logging.debug("Fake server: " + format % args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeShowdownServer(object):
+    """
+    Serves the fake client page, login and protocol on one port. team is
+    the player's team and opponent_team the scripted opponent's, both in
+    teambuilder export format; teams sent with /utm are ignored.
+    opponent_delay is how long the opponent thinks before each turn.
+    """
+
+    def __init__(self, team, opponent_team, host='127.0.0.1', port=0, seed=0,
+                 opponent_delay=0.0, opponent_factory=RandomOpponent):
+        self.team = team
+        self.opponent_team = opponent_team
+        self.seed = seed
+        self.opponent_delay = opponent_delay
+        self.opponent_factory = opponent_factory
+        self.challenge = hashlib.sha1(str(seed)).hexdigest()
+        self.battles = 0
+        self.replays = 0
+        self.lock = threading.Lock()
+        with open(PAGE) as fp:
+            self.page = fp.read()
+
+        self.httpd = ThreadingHTTPServer((host, port), FakeShowdownHandler)
+        self.httpd.fake = self
+        self.host, self.port = self.httpd.server_address
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%u/' % (self.host, self.port)
+
+    @property
+    def websocket_url(self):
+        return 'ws://%s:%u/showdown/websocket' % (self.host, self.port)
+
+    @property
+    def login_url(self):
+        return 'http://%s:%u/action.php' % (self.host, self.port)
+
+    @property
+    def replay_url(self):
+        return 'http://%s:%u/action.php?act=uploadreplay' % (self.host, self.port)
+
+    def upload_replay(self, params):
+        with self.lock:
+            self.replays += 1
+
+    def assertion(self, params):
+        userid = params.get('userid', params.get('name', ['guest']))[0]
+        return '%s,%s,2,%u' % (self.challenge, to_id(userid), time.time())
+
+    def next_battle(self):
+        with self.lock:
+            self.battles += 1
+            return self.battles
+
+    def start(self):
+        logging.info("Fake Showdown server on %s" % self.url)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def parse_args():
+    argparser = ArgumentParser()
+    argparser.add_argument('team')
+    argparser.add_argument('opponent_team')
+    argparser.add_argument('--host', default='127.0.0.1')
+    argparser.add_argument('--port', type=int, default=8000)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--opponent-delay-ms', type=float, default=0.0)
+
+    return argparser.parse_args()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    with open(args.team) as fp:
+        team = fp.read()
+    with open(args.opponent_team) as fp:
+        opponent_team = fp.read()
+    server = FakeShowdownServer(team, opponent_team, host=args.host, port=args.port, seed=args.seed,
+                                opponent_delay=args.opponent_delay_ms / 1000.0)
+    logging.info("SHOWDOWN_URL=%s SHOWDOWN_WEBSOCKET_URL=%s SHOWDOWN_LOGIN_URL=%s" % (server.url,
+                                                                                    server.websocket_url,
+                                                                                    server.login_url))
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
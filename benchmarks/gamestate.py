@@ -0,0 +1,190 @@
+"""
+Compares per-turn latency of the old per-element get_gamestate scrape
+against the single execute_script snapshot, using the saved battle pages
+in benchmarks/fixtures. Also times the old chain of icon title regexes
+against the combined, cached parser; --parser-only skips the browser.
+
+    python benchmarks/gamestate.py --browser phantomjs --iterations 50
+"""
+import os
+import re
+import sys
+import time
+import logging
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from showdown_parser import Gamestate, Pokemon
+
+from showdown_client import ShowdownClient
+from showdown_client.client import parse_icon_title, title_cache
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+NOT_ACTIVE_NICKNAME_FINE = r".+?\((?P<poke_name>.+?)\)$"
+NOT_ACTIVE_NICKNAME = r".+?\((?P<poke_name>.+?)\) \((?P<health>(.+?%(\|.+?)?|fainted|tox|brn|slp|par))\)$"
+NOT_ACTIVE_NO_NICKNAME = r"(?P<poke_name>.+?) \((?P<health>(.+?%(\|.+?)?|fainted|tox|brn|slp|par))\)$"
+ACTIVE_NO_NICKNAME = r"(?P<poke_name>.+) \(active\)$"
+ACTIVE_NICKNAME = r".+\((?P<poke_name>.+?)\) \(active\)$"
+
+CONDITIONS = set(["tox", "brn", "slp", "par"])
+
+def parse_args():
+    argparser = ArgumentParser()
+    argparser.add_argument('--browser', default='phantomjs')
+    argparser.add_argument('--iterations', type=int, default=20)
+    argparser.add_argument('--fixture', action='append')
+    argparser.add_argument('--parser-only', action='store_true')
+
+    return argparser.parse_args()
+
+def legacy_get_gamestate(client):
+    battle = client.selector('.battle')
+    my_trainer = client.selector('.trainer', client.selector('.leftbar', battle))
+    opp_trainer = client.selector('.trainer', client.selector('.rightbar', battle))
+    teams = ([], [])
+    primary = [None, None]
+    for i, icons in enumerate([client.selectors('.pokemonicon', my_trainer),
+                               client.selectors('.pokemonicon', opp_trainer)]):
+        for icon in icons:
+            text = icon.get_attribute('title')
+            if re.match(ACTIVE_NICKNAME, text):
+                match = re.match(ACTIVE_NICKNAME, text)
+                poke_name = match.group('poke_name')
+                faint = False
+                if i == 0:
+                    statbar = client.selector('.statbar.rstatbar')
+                else:
+                    statbar = client.selector('.statbar.lstatbar')
+                percent = client.selector('.hptext', statbar).text
+                primary[i] = poke_name
+            elif re.match(ACTIVE_NO_NICKNAME, text):
+                match = re.match(ACTIVE_NO_NICKNAME, text)
+                poke_name = match.group('poke_name')
+                faint = False
+                if i == 0:
+                    statbar = client.selector('.statbar.rstatbar')
+                else:
+                    statbar = client.selector('.statbar.lstatbar')
+                percent = client.selector('.hptext', statbar).text
+                primary[i] = poke_name
+            elif re.match(NOT_ACTIVE_NICKNAME, text):
+                match = re.match(NOT_ACTIVE_NICKNAME, text)
+                poke_name = match.group('poke_name')
+                if match.group('health') == 'fainted':
+                    faint = True
+                    percent = '0%'
+                else:
+                    faint = False
+                    percent = match.group('health').split('|')[0]
+                    if percent in CONDITIONS:
+                        percent = '100%'
+            elif re.match(NOT_ACTIVE_NO_NICKNAME, text):
+                match = re.match(NOT_ACTIVE_NO_NICKNAME, text)
+                poke_name = match.group('poke_name')
+                if match.group('health') == 'fainted':
+                    faint = True
+                    percent = '0%'
+                else:
+                    faint = False
+                    percent = match.group('health').split('|')[0]
+                    if percent in CONDITIONS:
+                        percent = '100%'
+            elif re.match(NOT_ACTIVE_NICKNAME_FINE, text):
+                match = re.match(NOT_ACTIVE_NICKNAME_FINE, text)
+                poke_name = match.group('poke_name')
+                faint = False
+                percent = '100%'
+            else:
+                poke_name = text
+                faint = False
+                percent = '100%'
+            health = float(percent[:-1]) / 100.0
+            poke = Pokemon(poke_name, faint=faint, health=health)
+            teams[i].append(poke)
+    gamestate = Gamestate(teams=teams)
+    for i, p in enumerate(primary):
+        if p is not None:
+            gamestate.set_primary(i, p)
+    return gamestate
+
+def legacy_parse_icon_title(text):
+    for pattern in [ACTIVE_NICKNAME, ACTIVE_NO_NICKNAME]:
+        match = re.match(pattern, text)
+        if match:
+            return match.group('poke_name'), True, False, None
+    for pattern in [NOT_ACTIVE_NICKNAME, NOT_ACTIVE_NO_NICKNAME]:
+        match = re.match(pattern, text)
+        if match:
+            if match.group('health') == 'fainted':
+                return match.group('poke_name'), False, True, 0.0
+            percent = match.group('health').split('|')[0]
+            if percent in CONDITIONS:
+                percent = '100%'
+            return match.group('poke_name'), False, False, float(percent[:-1]) / 100.0
+    match = re.match(NOT_ACTIVE_NICKNAME_FINE, text)
+    if match:
+        return match.group('poke_name'), False, False, 1.0
+    return text, False, False, 1.0
+
+def fixture_titles(fixtures):
+    titles = []
+    for fixture in fixtures:
+        with open(os.path.join(FIXTURES, fixture)) as fp:
+            titles.extend(re.findall(r'class="picon pokemonicon" title="([^"]+)"', fp.read()))
+    return titles
+
+def compare_parsers(titles, iterations):
+    for title in titles:
+        assert parse_icon_title(title)[:4] == legacy_parse_icon_title(title), "Parsers disagree on %s" % title
+    print "%u icon titles" % len(titles)
+    for name, func in [('legacy', legacy_parse_icon_title), ('combined', parse_icon_title)]:
+        start = time.time()
+        for _ in xrange(iterations):
+            for title in titles:
+                func(title)
+        print "  %-8s %7.2fus/title" % (name, (time.time() - start) / (iterations * len(titles)) * 1e6)
+    print "  cache hits %u, misses %u" % (title_cache.hits, title_cache.misses)
+
+def summarize(gamestate):
+    return [[(p.get_name(), p.health, p.faint) for p in gamestate.get_team(i)] for i in xrange(2)]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def time_calls(func, iterations):
+    timings = []
+    for _ in xrange(iterations):
+        start = time.time()
+        func()
+        timings.append((time.time() - start) * 1000.0)
+    return timings
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args()
+    fixtures = args.fixture or sorted(f for f in os.listdir(FIXTURES) if f.endswith('.html'))
+
+    compare_parsers(fixture_titles(fixtures), args.iterations * 100)
+    if args.parser_only:
+        sys.exit(0)
+
+    client = ShowdownClient(None, browser=args.browser)
+    client.set_state('battle_main')
+    try:
+        for fixture in fixtures:
+            client.driver.get('file://' + os.path.join(FIXTURES, fixture))
+            old, new = legacy_get_gamestate(client), client.get_gamestate()
+            assert summarize(old) == summarize(new), "Snapshot disagrees with legacy scrape on %s" % fixture
+            print fixture
+            for name, func in [('legacy', lambda: legacy_get_gamestate(client)),
+                               ('snapshot', client.get_gamestate)]:
+                timings = time_calls(func, args.iterations)
+                print "  %-8s mean %7.2fms  p50 %7.2fms  p95 %7.2fms" % (name,
+                                                                         sum(timings) / len(timings),
+                                                                         percentile(timings, 0.5),
+                                                                         percentile(timings, 0.95))
+    finally:
+        client.stop()
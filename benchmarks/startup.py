@@ -0,0 +1,88 @@
+"""
+Measures worker cold start: loading the pickled converter and weights and
+building the network, against loading the same model from a bundle. Every
+run happens in a fresh interpreter so backend imports are counted.
+
+    python benchmarks/startup.py models/converter.pkl --model model.pkl --runs 5
+
+Without --model only the converter is loaded and no network is built.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import cPickle as pickle
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+from showdown_client.bundle import save_bundle
+
+PICKLE_STARTUP = """
+import time
+start = time.time()
+import cPickle as pickle
+from showdown_client.bundle import build_net
+with open(%(converter)r) as fp:
+    converter = pickle.load(fp)
+if %(model)r is not None:
+    net = build_net(converter)
+    with open(%(model)r) as fp:
+        net.set_state(pickle.load(fp))
+print time.time() - start
+"""
+
+BUNDLE_STARTUP = """
+import time
+start = time.time()
+from showdown_client.bundle import build_net, load_bundle
+weights, converter = load_bundle(%(bundle)r)
+if %(model)r is not None:
+    net = build_net(converter)
+    net.set_state(weights)
+print time.time() - start
+"""
+
+def parse_args():
+    argparser = ArgumentParser()
+    argparser.add_argument('converter')
+    argparser.add_argument('--model')
+    argparser.add_argument('--runs', type=int, default=5)
+
+    return argparser.parse_args()
+
+def time_startup(script, runs):
+    timings = []
+    for _ in xrange(runs):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with open(args.converter) as fp:
+        converter = pickle.load(fp)
+    weights = None
+    if args.model:
+        with open(args.model) as fp:
+            weights = pickle.load(fp)
+
+    bundle = tempfile.mkdtemp(prefix='bundle-')
+    try:
+        save_bundle(bundle, weights, converter)
+        params = {
+            'converter': os.path.abspath(args.converter),
+            'model': os.path.abspath(args.model) if args.model else None,
+            'bundle': bundle,
+        }
+        for name, script in [('pickle', PICKLE_STARTUP), ('bundle', BUNDLE_STARTUP)]:
+            timings = sorted(time_startup(script % params, args.runs))
+            print "%-6s  min %6.3fs  median %6.3fs  max %6.3fs" % (name, timings[0],
+                                                                    timings[len(timings) // 2],
+                                                                    timings[-1])
+    finally:
+        shutil.rmtree(bundle)
@@ -0,0 +1,56 @@
+import glob
+import logging
+logging.basicConfig(level=logging.INFO)
+import cPickle as pickle
+from argparse import ArgumentParser
+
+from showdown_client import NeuralNetworkAgent
+from showdown_client.book import build_book
+from showdown_client.bundle import build_net, load_bundle, is_bundle
+from showdown_client.team import parse_team
+
+def parse_args():
+    argparser = ArgumentParser(description="Precompute leads and first moves for known team matchups.")
+    argparser.add_argument('model')
+    argparser.add_argument('converter', nargs='?')
+    argparser.add_argument('--teams', nargs='+', default=sorted(glob.glob('teams/*.txt')))
+    argparser.add_argument('--opponents', help="file with one opponent team per line, as comma-separated species")
+    argparser.add_argument('--opponent-teams', nargs='+', default=[])
+    argparser.add_argument('--batch-size', type=int, default=1024)
+    argparser.add_argument('--out', default='book.json')
+
+    return argparser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if is_bundle(args.model):
+        weights, converter = load_bundle(args.model)
+    else:
+        with open(args.converter) as fp:
+            converter = pickle.load(fp)
+        with open(args.model) as fp:
+            weights = pickle.load(fp)
+    net = build_net(converter)
+    net.set_state(weights)
+    agent = NeuralNetworkAgent(net, converter)
+
+    teams = []
+    for path in args.teams:
+        with open(path) as fp:
+            teams.append(parse_team(fp.read()))
+    opponents = []
+    if args.opponents:
+        with open(args.opponents) as fp:
+            for line in fp:
+                if line.strip():
+                    opponents.append([species.strip() for species in line.split(',')])
+    for path in args.opponent_teams:
+        with open(path) as fp:
+            opponents.append([poke['species'] for poke in parse_team(fp.read())])
+    if not opponents:
+        raise ValueError("No opponent teams given, use --opponents or --opponent-teams")
+
+    book = build_book(agent, teams, opponents, batch_size=args.batch_size)
+    logging.info("Writing %u entries to %s..." % (len(book), args.out))
+    book.save(args.out)
@@ -0,0 +1,26 @@
+import logging
+logging.basicConfig(level=logging.INFO)
+import cPickle as pickle
+from argparse import ArgumentParser
+
+from showdown_client.bundle import save_bundle
+
+def parse_args():
+    argparser = ArgumentParser(description="Convert a pickled model and converter into a model bundle.")
+    argparser.add_argument('model')
+    argparser.add_argument('converter')
+    argparser.add_argument('bundle')
+
+    return argparser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with open(args.converter) as fp:
+        converter = pickle.load(fp)
+
+    with open(args.model) as fp:
+        weights = pickle.load(fp)
+
+    logging.info("Writing bundle to %s..." % args.bundle)
+    save_bundle(args.bundle, weights, converter)
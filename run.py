@@ -2,39 +2,146 @@ import logging
 logging.basicConfig(level=logging.INFO)
 import cPickle as pickle
 from argparse import ArgumentParser
-from showdown_client import ShowdownClient, NeuralNetworkAgent
-
-from deepx.nn import Vector, Repeat, Tanh, Softmax
+from showdown_client import ShowdownClient, ProtocolClient, NeuralNetworkAgent, BattleOrchestrator, InferenceServer, IncrementalEncoder, Metrics, TurnProfiler, SessionPool, ReplayArchiver, TrajectoryRecorder, DeadlineScheduler, OpeningBook
+from showdown_client.bundle import build_net, load_bundle, is_bundle
+from showdown_client.client import SHOWDOWN_URL
+from showdown_client.protocol import SHOWDOWN_WEBSOCKET_URL, SHOWDOWN_LOGIN_URL
 
 def parse_args():
     argparser = ArgumentParser()
     argparser.add_argument('team')
     argparser.add_argument('model')
-    argparser.add_argument('converter')
+    argparser.add_argument('converter', nargs='?')
     argparser.add_argument('--browser', default='firefox')
+    argparser.add_argument('--backend', default='selenium', choices=['selenium', 'websocket'])
+    argparser.add_argument('--url')
+    argparser.add_argument('--login-url', default=SHOWDOWN_LOGIN_URL)
+    argparser.add_argument('--battles', type=int, default=10)
+    argparser.add_argument('--concurrency', type=int, default=1)
+    argparser.add_argument('--pool', action='store_true')
+    argparser.add_argument('--event-loop', action='store_true')
+    argparser.add_argument('--loop-threads', type=int, default=4)
+    argparser.add_argument('--recycle-battles', type=int, default=50)
+    argparser.add_argument('--max-rss-mb', type=float)
+    argparser.add_argument('--archive-dir')
+    argparser.add_argument('--record-dir')
+    argparser.add_argument('--turn-budget', type=float)
+    argparser.add_argument('--book')
+    argparser.add_argument('--timer-margin', type=float, default=5.0)
+    argparser.add_argument('--max-batch-size', type=int, default=32)
+    argparser.add_argument('--max-wait-ms', type=float, default=5.0)
+    argparser.add_argument('--incremental-encoding', action='store_true')
+    argparser.add_argument('--verify-encoding', action='store_true')
+    argparser.add_argument('--metrics-out')
+    argparser.add_argument('--metrics-format', default='jsonl', choices=['jsonl', 'prometheus'])
+    argparser.add_argument('--profile-turns', type=int, default=0)
+    argparser.add_argument('--profile-dir', default='profiles')
 
     return argparser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
+    if args.pool and args.backend != 'selenium':
+        raise ValueError("--pool only applies to the selenium backend")
+    if args.event_loop and args.pool:
+        raise ValueError("--event-loop does not apply with --pool")
 
     with open(args.team) as fp:
         team_text = fp.read()
 
-    with open(args.converter) as fp:
-        converter = pickle.load(fp)
+    if is_bundle(args.model):
+        weights, converter = load_bundle(args.model)
+    else:
+        with open(args.converter) as fp:
+            converter = pickle.load(fp)
+        with open(args.model) as fp:
+            weights = pickle.load(fp)
+
+    net = build_net(converter)
+    net.set_state(weights)
+
+    inference = None
+    if args.concurrency > 1:
+        inference = InferenceServer(net, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000.0)
+        inference.start()
+    encoder = None
+    if args.incremental_encoding:
+        encoder = IncrementalEncoder(converter, debug=args.verify_encoding)
+    book = OpeningBook.load(args.book) if args.book else None
+    agent = NeuralNetworkAgent(net, converter, inference=inference, encoder=encoder, book=book)
+
+    metrics = Metrics()
+    profiler = TurnProfiler(args.profile_turns) if args.profile_turns > 0 else None
+    archiver = None
+    if args.archive_dir:
+        archiver = ReplayArchiver(args.archive_dir, metrics=metrics)
+        archiver.start()
+    recorder = None
+    if args.record_dir:
+        recorder = TrajectoryRecorder(args.record_dir, converter, encoder=encoder)
+
+    def create_client(index):
+        scheduler = None
+        if args.turn_budget:
+            scheduler = DeadlineScheduler(budget=args.turn_budget, margin=args.timer_margin, metrics=metrics)
+        if args.backend == 'websocket':
+            return ProtocolClient(agent, url=args.url or SHOWDOWN_WEBSOCKET_URL, login_url=args.login_url,
+                                  metrics=metrics, profiler=profiler, archiver=archiver, recorder=recorder,
+                                  scheduler=scheduler)
+        return ShowdownClient(agent, browser=args.browser, url=args.url or SHOWDOWN_URL,
+                              metrics=metrics, profiler=profiler, archiver=archiver, recorder=recorder,
+                              scheduler=scheduler)
+
+    def setup(client, index, warm=False):
+        if index == 0:
+            client.choose_name('asdf141231232', 'onmabd')
+        else:
+            client.choose_name('asdf141231232%u' % index)
+        if not warm:
+            client.mute()
+            client.teambuilder()
+            client.create_team(team_text, 'lopunny')
+            client.home()
+
+        client.select_battle_format('ou')
 
-    net = Vector(converter.get_input_dimension()) >> Repeat(Tanh(1000), 2) >> Softmax(converter.get_output_dimension())
-    with open(args.model) as fp:
-        net.set_state(pickle.load(fp))
+    def make_client(index):
+        client = create_client(index)
+        client.start()
+        setup(client, index)
+        return client
 
-    client = ShowdownClient(NeuralNetworkAgent(net, converter), browser=args.browser)
-    client.start()
-    client.choose_name('asdf141231232', 'onmabd')
-    client.mute()
-    client.teambuilder()
-    client.create_team(team_text, 'lopunny')
-    client.home()
+    if args.event_loop:
+        from showdown_client.aio import run_battles
+        clients = [make_client(i) for i in xrange(args.concurrency)]
+        summary = run_battles(clients, args.battles, threads=args.loop_threads)
+        logging.info("Summary: %s" % summary)
+        for client in clients:
+            if client.get_state() != 'stopped':
+                client.stop()
+        if inference is not None:
+            logging.info("Inference: %s" % inference.metrics())
+            inference.stop()
+    elif args.pool or args.concurrency > 1:
+        pool = None
+        if args.pool:
+            pool = SessionPool(create_client, setup, size=args.concurrency, max_battles=args.recycle_battles,
+                               max_rss_mb=args.max_rss_mb)
+            pool.start()
+        summary = BattleOrchestrator(make_client, concurrency=args.concurrency, pool=pool).run(args.battles)
+        logging.info("Summary: %s" % summary)
+        if pool is not None:
+            logging.info("Recycled %u browser sessions" % pool.recycled)
+            pool.stop()
+        if inference is not None:
+            logging.info("Inference: %s" % inference.metrics())
+            inference.stop()
+    else:
+        make_client(0).play(args.battles)
 
-    client.select_battle_format('ou')
-    client.play(10)
+    if archiver is not None:
+        archiver.stop()
+    if args.metrics_out:
+        metrics.write(args.metrics_out, format=args.metrics_format)
+    if profiler is not None:
+        profiler.dump(args.profile_dir)
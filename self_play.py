@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import logging
+logging.basicConfig(level=logging.INFO)
+import cPickle as pickle
+from argparse import ArgumentParser
+
+from showdown_client import NeuralNetworkAgent, RandomAgent, TrajectoryRecorder
+from showdown_client.bundle import build_net, load_bundle, is_bundle
+from showdown_client.selfplay import SelfPlay, summarize
+from showdown_client.team import parse_team
+
+def parse_args():
+    argparser = ArgumentParser(description="Play agents against each other in the local sim, without a browser.")
+    argparser.add_argument('team')
+    argparser.add_argument('model', nargs='?', help="omit to play random agents")
+    argparser.add_argument('converter', nargs='?')
+    argparser.add_argument('--opponent-team')
+    argparser.add_argument('--random-opponent', action='store_true')
+    argparser.add_argument('--games', type=int, default=100)
+    argparser.add_argument('--processes', type=int)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--max-turns', type=int, default=300)
+    argparser.add_argument('--record-dir')
+    argparser.add_argument('--results', default='selfplay.jsonl')
+    argparser.add_argument('--verbose', action='store_true')
+
+    return argparser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    teams = []
+    for path in [args.team, args.opponent_team or args.team]:
+        with open(path) as fp:
+            teams.append(parse_team(fp.read()))
+
+    weights, converter = None, None
+    if args.model:
+        if is_bundle(args.model):
+            weights, converter = load_bundle(args.model)
+        else:
+            with open(args.converter) as fp:
+                converter = pickle.load(fp)
+            with open(args.model) as fp:
+                weights = pickle.load(fp)
+    elif args.record_dir:
+        raise ValueError("--record-dir needs a model and converter to encode states")
+
+    # Both are called in each worker process, so every worker builds its
+    # own network and writes its own trajectory shards.
+    def make_agents():
+        if converter is None:
+            return RandomAgent(), RandomAgent()
+        net = build_net(converter)
+        net.set_state(weights)
+        agent = NeuralNetworkAgent(net, converter)
+        return agent, RandomAgent() if args.random_opponent else agent
+
+    def make_recorder():
+        return TrajectoryRecorder(os.path.join(args.record_dir, 'worker-%u' % os.getpid()), converter)
+
+    selfplay = SelfPlay(make_agents, teams, processes=args.processes,
+                        make_recorder=make_recorder if args.record_dir else None,
+                        max_turns=args.max_turns, quiet=not args.verbose)
+    start = time.time()
+    results = selfplay.run(args.games, seed=args.seed)
+    elapsed = time.time() - start
+
+    with open(args.results, 'w') as fp:
+        fp.write(''.join(json.dumps(result._asdict()) + '\n' for result in results))
+    logging.info("Summary: %s" % summarize(results, elapsed))
@@ -1,2 +1,13 @@
 from client import ShowdownClient
+from protocol import ProtocolClient
+from orchestrator import BattleOrchestrator, BattleResult
 from agent import *
+from inference import InferenceServer
+from encoding import IncrementalEncoder
+from metrics import Metrics, TurnProfiler
+from pool import SessionPool
+from archive import ReplayArchiver
+from trajectory import TrajectoryRecorder, TrajectoryShard, iter_shards
+from deadline import DeadlineScheduler
+from book import OpeningBook
+from selfplay import SelfPlay
@@ -1,10 +1,44 @@
+import random
+
+import numpy as np
+
 from showdown_parser import Action, Switch
 
+def action_key(action):
+    return (action.is_move(), action.get_name())
+
 class Agent(object):
 
     def get_action(self, gamestate, legal_actions):
         raise NotImplementedError()
 
+    def get_action_by(self, deadline, gamestate, legal_actions, initial=False):
+        """
+        Like get_action, for callers that will stop waiting at deadline.
+        Agents that can trade quality for time should finish before it.
+        """
+        return self.get_action(gamestate, legal_actions, initial=initial)
+
+    def reseed(self, seed):
+        """
+        Resets any randomness the agent uses, so a game can be replayed.
+        """
+        pass
+
+    def fallback_action(self, gamestate, legal_actions):
+        """
+        A choice that costs nothing to compute, for when get_action runs out
+        of time: the first legal move, or else a switch to the healthiest
+        Pokemon.
+        """
+        if not legal_actions:
+            return None
+        for action in legal_actions:
+            if action.is_move():
+                return action
+        health = dict((poke.get_name(), poke.health) for poke in gamestate.get_team(0))
+        return max(legal_actions, key=lambda action: health.get(action.get_name(), 0.0))
+
 class InteractiveAgent(Agent):
 
     def get_action(self, gamestate, legal_actions, initial=False):
@@ -15,26 +49,87 @@ class InteractiveAgent(Agent):
         action_string = raw_input(">>> ")
         return Action.from_string(action_string)
 
+class RandomAgent(Agent):
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def reseed(self, seed):
+        self.rng.seed(seed)
+
+    def get_action(self, gamestate, legal_actions, initial=False):
+        if not legal_actions:
+            return None
+        return self.rng.choice(legal_actions)
+
 class NeuralNetworkAgent(Agent):
 
-    def __init__(self, net, converter):
+    def __init__(self, net, converter, inference=None, encoder=None, book=None):
         self.net = net
         self.converter = converter
+        self.inference = inference
+        self.encoder = encoder
+        self.book = book
+
+        self.actions = converter.get_actions()
+        self.action_index = dict((action_key(action), i) for i, action in enumerate(self.actions))
+        self.move_mask = np.array([action.is_move() for action in self.actions], dtype=bool)
+
+    def predict_probs(self, state):
+        if self.encoder is not None:
+            x = self.encoder.encode_state(state, getattr(state, 'battle_id', None))
+        else:
+            x = self.converter.encode_state(state)
+        state.encoded = x
+
+        if self.inference is not None:
+            return self.inference.predict(x)
+        return self.net.predict(x[None])[0]
 
     def predict(self, state):
+        probs = self.predict_probs(state)
+        order = np.argsort(-probs, kind='mergesort')
+        return probs[order].tolist(), [self.actions[i] for i in order]
 
-        x = self.converter.encode_state(state)
+    def legal_mask(self, legal_actions):
+        mask = np.zeros(len(self.actions), dtype=bool)
+        for action in legal_actions:
+            i = self.action_index.get(action_key(action))
+            if i is not None:
+                mask[i] = True
+        return mask
 
-        probs = self.net.predict(x[None])[0].tolist()
-        actions = self.converter.get_actions()
+    def top_k(self, probs, k):
+        k = min(k, len(probs))
+        top = np.argpartition(-probs, k - 1)[:k]
+        return top[np.argsort(-probs[top], kind='mergesort')]
 
-        best = sorted(zip(probs, actions), key=lambda x: -x[0])
+    def select_action(self, probs, legal_actions, initial=False):
+        """
+        Returns the index of the most probable legal action. During team
+        preview moves count as candidates too, matching the ranked walk in
+        get_action: a move outranking every legal lead keeps the current one.
+        """
+        mask = self.legal_mask(legal_actions)
+        if initial:
+            mask |= self.move_mask
+        if not mask.any():
+            return None
+        return int(np.where(mask, probs, -np.inf).argmax())
 
-        probs, actions = zip(*best)
-        return probs, actions
+    def book_action(self, state, legal_actions, initial=False):
+        if self.book is None:
+            return None
+        action = self.book.get_action(state, legal_actions, initial=initial)
+        if action is not None:
+            print "Opening book:", action
+        return action
 
     def get_action(self, state, legal_actions, initial=False):
-        probs, actions = self.predict(state)
+        action = self.book_action(state, legal_actions, initial=initial)
+        if action is not None:
+            return action
+        probs = self.predict_probs(state)
 
         print "================================"
         print "Matchup: %s[%.2f] vs %s[%.2f]" % (state.get_primary(0).name,
@@ -47,11 +142,13 @@ class NeuralNetworkAgent(Agent):
         print "Their team: %s" % ', '.join(["%s[%.2f]" % ((p.get_name()), p.health) for p in state.get_team(1)[1:]])
         print
         print
-        for i, (prob, action) in enumerate(zip(probs, actions)[:5]):
-            print "Prediction[%u]: %s (%.3f)" % (i + 1, action, prob)
-        for action in actions:
-            if initial and action.is_move():
-                return Switch(state.get_primary(0).get_name())
-            if action in legal_actions:
-                print "Choice:", action
-                return action
+        for i, index in enumerate(self.top_k(probs, 5)):
+            print "Prediction[%u]: %s (%.3f)" % (i + 1, self.actions[index], probs[index])
+        index = self.select_action(probs, legal_actions, initial=initial)
+        if index is None:
+            return None
+        action = self.actions[index]
+        if initial and action.is_move():
+            return Switch(state.get_primary(0).get_name())
+        print "Choice:", action
+        return action
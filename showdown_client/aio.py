@@ -0,0 +1,203 @@
+import ssl
+import time
+import errno
+import socket
+import logging
+from collections import deque
+
+import trollius as asyncio
+from trollius import From, Return
+from concurrent.futures import ThreadPoolExecutor
+
+from steps import WAIT, DONE
+from states import StateException
+from protocol import ProtocolClient
+from orchestrator import BattleRecord, summarize
+
+def would_block(error):
+    if isinstance(error, ssl.SSLWantReadError):
+        return True
+    return getattr(error, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class AsyncShowdownClient(object):
+    """
+    Drives a ShowdownClient from an event loop. The battle itself is
+    ShowdownClient.battle_steps; its steps run on executors, since
+    selenium only has blocking calls. So this is a thread-pool wrapper:
+    each wait on the page holds a thread of waits for as long as it lasts,
+    and waits needs a thread per session, as many as BattleOrchestrator
+    uses. What the loop adds is that sessions share one pool, executor, for
+    their short driver calls and agent decisions. The wrapped client keeps
+    its synchronous API for the rest.
+    """
+
+    def __init__(self, client, executor=None, waits=None, loop=None):
+        self.client = client
+        self.executor = executor
+        self.waits = waits
+        self.loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def start(self):
+        yield From(self.loop.run_in_executor(self.executor, self.client.start))
+
+    @asyncio.coroutine
+    def stop(self):
+        yield From(self.loop.run_in_executor(self.executor, self.client.stop))
+
+    @asyncio.coroutine
+    def play(self, n_iters):
+        logging.info("Playing %u battles..." % n_iters)
+        results = []
+        for i in xrange(n_iters):
+            result = yield From(self.battle(search_next=i + 1 < n_iters))
+            results.append(result)
+        raise Return(results)
+
+    @asyncio.coroutine
+    def battle(self, search_next=False):
+        client = self.client
+        if client.get_state() != 'homepage':
+            raise StateException('battle', ['homepage'], client.get_state())
+        steps = client.battle_steps(search_next)
+        result = None
+        while True:
+            kind, value = steps.send(result)
+            if kind == DONE:
+                steps.close()
+                client.set_state('homepage')
+                raise Return(value)
+            result = yield From(self.step(kind, value))
+
+    @asyncio.coroutine
+    def step(self, kind, value):
+        executor = self.waits if kind == WAIT else self.executor
+        result = yield From(self.loop.run_in_executor(executor, value))
+        raise Return(result)
+
+class AsyncProtocolClient(AsyncShowdownClient):
+    """
+    Drives a ProtocolClient from an event loop without a thread per battle.
+    Its waits are reads from the websocket: the loop watches the socket,
+    and once it is readable everything it holds is read without blocking
+    into the client's inbox, from which the Receive step takes one message
+    on the loop thread. The websocket library keeps a partly read frame
+    until the rest arrives. Agent decisions still run on executor.
+    """
+
+    @asyncio.coroutine
+    def step(self, kind, value):
+        if kind != WAIT:
+            result = yield From(super(AsyncProtocolClient, self).step(kind, value))
+            raise Return(result)
+        yield From(self.read(value.timeout))
+        raise Return(value() if self.client.inbox else None)
+
+    def drain(self):
+        connection = self.client.connection
+        connection.settimeout(0.0)
+        try:
+            while True:
+                self.client.inbox.append(connection.recv())
+        except socket.error as e:
+            if not would_block(e):
+                raise
+        finally:
+            connection.settimeout(None)
+
+    @asyncio.coroutine
+    def read(self, timeout=None):
+        """
+        Waits until the client's inbox holds a message, at most timeout
+        seconds if timeout is not None. The socket is drained before the
+        first wait, since an SSL connection can hold data it has already
+        read off the socket.
+        """
+        deadline = None if timeout is None else self.loop.time() + timeout
+        fd = self.client.connection.fileno()
+        while True:
+            self.drain()
+            remaining = None if deadline is None else deadline - self.loop.time()
+            if self.client.inbox or (remaining is not None and remaining <= 0):
+                return
+            readable = asyncio.Future(loop=self.loop)
+            self.loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                yield From(asyncio.wait([readable], timeout=remaining, loop=self.loop))
+            finally:
+                self.loop.remove_reader(fd)
+
+@asyncio.coroutine
+def play_all(clients, records):
+    """
+    Plays records on clients, one coroutine per client, sharing out the
+    battles the way BattleOrchestrator.work does: a client claims its next
+    battle only as its current one ends. A client that fails a battle is
+    stopped and the others finish the rest.
+    """
+    queue = list(records)
+    unclaimed = [len(records)]
+
+    def claim():
+        if unclaimed[0] == 0:
+            return False
+        unclaimed[0] -= 1
+        return True
+
+    @asyncio.coroutine
+    def work(worker_id, client):
+        claimed = claim()
+        while claimed:
+            record = queue.pop(0)
+            searched = []
+            def search_next():
+                searched.append(claim())
+                return searched[0]
+            record.status = 'running'
+            record.worker = worker_id
+            try:
+                record.result = yield From(client.battle(search_next=search_next))
+                record.status = 'done'
+            except Exception as e:
+                logging.exception("Battle %u failed on session %u" % (record.index, worker_id))
+                record.status = 'failed'
+                record.error = e
+                if searched and searched[0]:
+                    unclaimed[0] += 1
+                try:
+                    yield From(client.stop())
+                except Exception:
+                    logging.exception("Could not stop session")
+                return
+            claimed = searched[0] if searched else claim()
+
+    yield From(asyncio.gather(*[work(i, client) for i, client in enumerate(clients)]))
+
+def run_battles(clients, n_battles, threads=4, loop=None):
+    """
+    Synchronous entry point: plays n_battles on clients that are logged in
+    and on the home page, all on one event loop, and returns the
+    orchestrator's summary. ProtocolClients read their websockets on the
+    loop itself; ShowdownClients' waits get one thread each. Agent
+    decisions and other short calls share a pool of threads.
+    """
+    loop = loop or asyncio.get_event_loop()
+    browsers = sum(1 for client in clients if not isinstance(client, ProtocolClient))
+    executor = ThreadPoolExecutor(max_workers=threads)
+    waits = ThreadPoolExecutor(max_workers=browsers) if browsers else None
+    wrapped = []
+    for client in clients:
+        if isinstance(client, ProtocolClient):
+            wrapped.append(AsyncProtocolClient(client, executor=executor, loop=loop))
+        else:
+            wrapped.append(AsyncShowdownClient(client, executor=executor, waits=waits, loop=loop))
+    records = [BattleRecord(i) for i in xrange(n_battles)]
+    logging.info("Playing %u battles with %u sessions on one event loop..." % (n_battles, len(clients)))
+    start = time.time()
+    try:
+        loop.run_until_complete(play_all(wrapped, records))
+    finally:
+        executor.shutdown()
+        if waits is not None:
+            waits.shutdown()
+    return summarize(records, time.time() - start)
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import logging
+import urllib
+import urllib2
+import threading
+from Queue import Queue, Full
+
+from metrics import Metrics
+
+SHOWDOWN_REPLAY_URL = os.environ.get('SHOWDOWN_REPLAY_URL',
+                                     'https://play.pokemonshowdown.com/~~showdown/action.php?act=uploadreplay')
+
+REPLAY_TIMEOUT = 5
+UPLOAD_TIMEOUT = 30
+
+class ArchiveJob(object):
+
+    def __init__(self, battle_id, log=None, result=None, upload=None):
+        self.battle_id = battle_id
+        self.log = log
+        self.result = result
+        self.upload = upload
+        self.stored = log is None
+        self.attempts = 0
+
+def room_name(battle_id):
+    return battle_id.rstrip('/').rsplit('/', 1)[-1]
+
+def upload_replay(url, replay):
+    """
+    Posts the server's answer to /savereplay to the replay server.
+    """
+    data = urllib.urlencode({
+        'log': replay['log'].encode('utf-8'),
+        'id': replay['id'],
+        'password': replay.get('password', ''),
+    })
+    response = urllib2.urlopen(url, data, UPLOAD_TIMEOUT).read()
+    if 'success' not in response:
+        raise IOError("Replay upload failed: %s" % response)
+
+def upload_in_background(url, replay):
+    """
+    Uploads a replay once on a thread of its own, for clients without an
+    archiver. The thread is not a daemon, so the last upload of a run still
+    finishes before the interpreter exits.
+    """
+    def upload():
+        try:
+            upload_replay(url, replay)
+        except Exception:
+            logging.exception("Could not upload replay %s" % replay['id'])
+    thread = threading.Thread(target=upload)
+    thread.start()
+    return thread
+
+class ReplayArchiver(object):
+    """
+    Does end-of-battle work off the battle loop. Each job writes the battle
+    log to directory/<room>.log, appends its result to directory/index.jsonl
+    and then runs its upload callable, if any. A failing job is retried
+    with exponential backoff; when more than max_queue jobs are waiting, new
+    jobs are dropped instead of blocking the bot that submits them.
+    """
+
+    def __init__(self, directory='replays', max_queue=256, retries=3, backoff=1.0, metrics=None):
+        self.directory = directory
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics or Metrics()
+        self.queue = Queue(max_queue)
+        self.thread = None
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Finishes the jobs already queued, waiting at most timeout seconds.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def submit(self, battle_id, log=None, result=None, upload=None):
+        try:
+            self.queue.put_nowait(ArchiveJob(battle_id, log=log, result=result, upload=upload))
+        except Full:
+            logging.warning("Archive queue is full, dropping %s" % battle_id)
+            self.metrics.increment('archive_dropped')
+            return False
+        return True
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.process(job)
+
+    def process(self, job):
+        while True:
+            job.attempts += 1
+            try:
+                if not job.stored:
+                    self.store(job)
+                    job.stored = True
+                if job.upload is not None:
+                    job.upload()
+                self.metrics.increment('archive_saved')
+                return
+            except Exception:
+                if job.attempts > self.retries:
+                    logging.exception("Could not archive %s after %u attempts" % (job.battle_id, job.attempts))
+                    self.metrics.increment('archive_failed')
+                    return
+                logging.warning("Archiving %s failed, retrying" % job.battle_id)
+                self.metrics.increment('archive_retries')
+                time.sleep(self.backoff * 2 ** (job.attempts - 1))
+
+    def store(self, job):
+        name = room_name(job.battle_id)
+        log = job.log.encode('utf-8') if isinstance(job.log, unicode) else job.log
+        with open(os.path.join(self.directory, '%s.log' % name), 'w') as fp:
+            fp.write(log)
+        entry = {'battle_id': job.battle_id, 'time': time.time()}
+        if job.result is not None:
+            entry.update(job.result._asdict())
+        with open(os.path.join(self.directory, 'index.jsonl'), 'a') as fp:
+            fp.write(json.dumps(entry) + '\n')
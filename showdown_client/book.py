@@ -0,0 +1,126 @@
+import json
+import logging
+
+import numpy as np
+
+from showdown_parser import Gamestate, Pokemon, Move, Switch
+
+BOOK_FORMAT = 1
+
+def book_key(team, opponent):
+    return (tuple(sorted(team)), tuple(sorted(opponent)))
+
+def is_first_turn(gamestate):
+    """
+    True on turn 1, as reported by the client in gamestate.turn.
+    """
+    return getattr(gamestate, 'turn', None) == 1
+
+class OpeningBook(object):
+    """
+    Precomputed decisions for the start of a battle, keyed on our team and
+    the opponent's six species regardless of order. Each entry holds the
+    lead to pick at team preview and, for every opponent lead, the action
+    to take with it on turn 1; gamestates without a turn only get the lead.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, team, opponent, lead, first_actions):
+        self.entries[book_key(team, opponent)] = {'lead': lead, 'first': first_actions}
+
+    def get_action(self, gamestate, legal_actions, initial=False):
+        """
+        Returns the book's action for this gamestate if it has one and it is
+        legal, otherwise None.
+        """
+        team = [poke.get_name() for poke in gamestate.get_team(0)]
+        opponent = [poke.get_name() for poke in gamestate.get_team(1)]
+        entry = self.entries.get(book_key(team, opponent))
+        action = None
+        if entry is not None:
+            if initial:
+                action = Switch(entry['lead'])
+            elif gamestate.get_primary(0).get_name() == entry['lead'] and is_first_turn(gamestate):
+                first = entry['first'].get(gamestate.get_primary(1).get_name())
+                if first is not None:
+                    kind, name = first
+                    action = Move(name) if kind == 'move' else Switch(name)
+        if action is None or action not in legal_actions:
+            return None
+        return action
+
+    def save(self, path):
+        entries = [{
+            'team': list(team),
+            'opponent': list(opponent),
+            'lead': entry['lead'],
+            'first': entry['first'],
+        } for (team, opponent), entry in sorted(self.entries.items())]
+        with open(path, 'w') as fp:
+            json.dump({'format': BOOK_FORMAT, 'entries': entries}, fp, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fp:
+            data = json.load(fp)
+        if data['format'] != BOOK_FORMAT:
+            raise ValueError("Unsupported opening book format: %s" % data['format'])
+        book = cls()
+        for entry in data['entries']:
+            book.add(entry['team'], entry['opponent'], entry['lead'],
+                     dict((lead, tuple(first)) for lead, first in entry['first'].items()))
+        return book
+
+def make_gamestate(team, opponent, lead=None, opponent_lead=None):
+    gamestate = Gamestate(teams=([Pokemon(species) for species in team], [Pokemon(species) for species in opponent]))
+    if lead is not None:
+        gamestate.set_primary(0, lead)
+        gamestate.set_primary(1, opponent_lead)
+    return gamestate
+
+def predict_batch(agent, states, batch_size=1024):
+    x = np.array([agent.converter.encode_state(state) for state in states])
+    return np.concatenate([agent.net.predict(x[i:i + batch_size]) for i in xrange(0, len(x), batch_size)])
+
+def build_book(agent, teams, opponents, batch_size=1024):
+    """
+    Runs the agent's network over every (team, opponent) pair in two
+    batched passes: one for the lead, then one for the first action of that
+    lead against each possible opponent lead. teams are parsed teams (see
+    team.parse_team) and opponents lists of six species.
+    """
+    pairs = [(team, opponent) for team in teams for opponent in opponents]
+    logging.info("Choosing leads for %u matchups..." % len(pairs))
+    states = [make_gamestate([poke['species'] for poke in team], opponent) for team, opponent in pairs]
+    leads = []
+    for state, probs, (team, opponent) in zip(states, predict_batch(agent, states, batch_size), pairs):
+        legal = [Switch(poke['species']) for poke in team]
+        index = agent.select_action(probs, legal, initial=True)
+        action = agent.actions[index] if index is not None else legal[0]
+        leads.append(state.get_primary(0).get_name() if action.is_move() else action.get_name())
+
+    logging.info("Choosing first actions...")
+    states, legals, slots = [], [], []
+    for i, ((team, opponent), lead) in enumerate(zip(pairs, leads)):
+        species = [poke['species'] for poke in team]
+        moves = [poke['moves'] for poke in team if poke['species'] == lead][0]
+        for opponent_lead in opponent:
+            states.append(make_gamestate(species, opponent, lead, opponent_lead))
+            legals.append([Move(move) for move in moves] + [Switch(s) for s in species if s != lead])
+            slots.append((i, opponent_lead))
+    first = [{} for _ in pairs]
+    for probs, legal, (i, opponent_lead) in zip(predict_batch(agent, states, batch_size), legals, slots):
+        index = agent.select_action(probs, legal)
+        if index is not None:
+            action = agent.actions[index]
+            first[i][opponent_lead] = ('move' if action.is_move() else 'switch', action.get_name())
+
+    book = OpeningBook()
+    for (team, opponent), lead, first_actions in zip(pairs, leads, first):
+        book.add([poke['species'] for poke in team], opponent, lead, first_actions)
+    return book
@@ -0,0 +1,116 @@
+import io
+import os
+import json
+import importlib
+
+import numpy as np
+
+BUNDLE_FORMAT = 1
+
+MANIFEST = 'manifest.json'
+
+def build_net(converter):
+    # deepx pulls in Theano/TensorFlow, so only import it when a network is needed
+    from deepx.nn import Vector, Repeat, Tanh, Softmax
+    return Vector(converter.get_input_dimension()) >> Repeat(Tanh(1000), 2) >> Softmax(converter.get_output_dimension())
+
+def save_weights(state, path, arrays):
+    if isinstance(state, np.ndarray):
+        name = '%04u.npy' % len(arrays)
+        np.save(os.path.join(path, name), state)
+        arrays.append(name)
+        return {'array': name}
+    if isinstance(state, dict):
+        return {'dict': [[save_weights(key, path, arrays), save_weights(value, path, arrays)]
+                         for key, value in state.items()]}
+    if isinstance(state, (list, tuple)):
+        return {'tuple' if isinstance(state, tuple) else 'list': [save_weights(value, path, arrays)
+                                                                  for value in state]}
+    if isinstance(state, np.generic):
+        state = state.item()
+    if state is None or isinstance(state, (bool, int, long, float, basestring)):
+        return {'value': state}
+    raise ValueError("Cannot store %s in a model bundle" % type(state).__name__)
+
+def load_weights(spec, path, mmap):
+    if 'array' in spec:
+        return np.load(os.path.join(path, spec['array']), mmap_mode='r' if mmap else None)
+    if 'dict' in spec:
+        return dict((load_weights(key, path, mmap), load_weights(value, path, mmap)) for key, value in spec['dict'])
+    if 'list' in spec:
+        return [load_weights(value, path, mmap) for value in spec['list']]
+    if 'tuple' in spec:
+        return tuple(load_weights(value, path, mmap) for value in spec['tuple'])
+    return spec['value']
+
+def save_converter(converter, path):
+    """
+    Stores the converter's vocabularies as one name per line in index order.
+    Forward mappings that are just the inverse of a vocabulary are rebuilt
+    on load instead of being written out.
+    """
+    attributes = {}
+    state = converter.__dict__
+    for name, value in state.items():
+        if isinstance(value, list) and all(isinstance(item, basestring) for item in value):
+            filename = '%s.txt' % name
+            with io.open(os.path.join(path, filename), 'w', encoding='utf-8') as fp:
+                for item in value:
+                    fp.write(u'%s\n' % item)
+            attributes[name] = {'names': filename}
+        elif isinstance(value, (bool, int, long, float, basestring)) or value is None:
+            attributes[name] = {'value': value}
+    for name, value in state.items():
+        if name in attributes:
+            continue
+        if isinstance(value, dict):
+            for source, spec in attributes.items():
+                if 'names' in spec and value == dict((item, i) for i, item in enumerate(state[source])):
+                    attributes[name] = {'inverse': source}
+                    break
+        if name not in attributes:
+            raise ValueError("Cannot store converter attribute %s in a model bundle" % name)
+    cls = converter.__class__
+    return {'class': '%s.%s' % (cls.__module__, cls.__name__), 'attributes': attributes}
+
+def load_converter(spec, path):
+    module, name = spec['class'].rsplit('.', 1)
+    cls = getattr(importlib.import_module(module), name)
+    converter = cls.__new__(cls)
+    state = {}
+    for name, attribute in spec['attributes'].items():
+        if 'names' in attribute:
+            with io.open(os.path.join(path, attribute['names']), encoding='utf-8') as fp:
+                state[name] = fp.read().splitlines()
+        elif 'value' in attribute:
+            state[name] = attribute['value']
+    for name, attribute in spec['attributes'].items():
+        if 'inverse' in attribute:
+            state[name] = dict((item, i) for i, item in enumerate(state[attribute['inverse']]))
+    converter.__dict__.update(state)
+    return converter
+
+def save_bundle(path, weights, converter):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'converter': save_converter(converter, path),
+        'weights': save_weights(weights, path, []),
+    }
+    with open(os.path.join(path, MANIFEST), 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+
+def load_bundle(path, mmap=True):
+    """
+    Returns (weights, converter) from a bundle written by save_bundle. With
+    mmap=True weight arrays are memory-mapped rather than read up front.
+    """
+    with open(os.path.join(path, MANIFEST)) as fp:
+        manifest = json.load(fp)
+    if manifest['format'] != BUNDLE_FORMAT:
+        raise ValueError("Unsupported model bundle format: %s" % manifest['format'])
+    return load_weights(manifest['weights'], path, mmap), load_converter(manifest['converter'], path)
+
+def is_bundle(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
@@ -0,0 +1,74 @@
+import threading
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+class LRUCache(object):
+    """
+    Thread-safe dict with a bounded number of entries; the least recently
+    used entry is evicted first. Entries sit on a circular doubly linked
+    list of [prev, next, key, value] links, so a hit is a dict lookup and a
+    few pointer swaps.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def append(self, link):
+        last = self.root[PREV]
+        last[NEXT] = self.root[PREV] = link
+        link[PREV], link[NEXT] = last, self.root
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.entries.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.unlink(link)
+            self.append(link)
+            self.hits += 1
+            return link[VALUE]
+
+    def put(self, key, value):
+        with self.lock:
+            link = self.entries.get(key)
+            if link is not None:
+                self.unlink(link)
+                link[VALUE] = value
+            else:
+                link = [None, None, key, value]
+                self.entries[key] = link
+            self.append(link)
+            if len(self.entries) > self.maxsize:
+                oldest = self.root[NEXT]
+                self.unlink(oldest)
+                del self.entries[oldest[KEY]]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            link = self.entries.pop(key, None)
+            if link is None:
+                return default
+            self.unlink(link)
+            return link[VALUE]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,73 +1,306 @@
+import os
 import re
+import json
+import time
 import logging
+from functools import partial
 
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
 
 from showdown_parser import Gamestate, Pokemon, Move, Switch
 
-SHOWDOWN_URL = 'https://play.pokemonshowdown.com/'
-
-NOT_ACTIVE_NICKNAME_FINE = r".+?\((?P<poke_name>.+?)\)$"
-NOT_ACTIVE_NICKNAME = r".+?\((?P<poke_name>.+?)\) \((?P<health>(.+?%(\|.+?)?|fainted|tox|brn|slp|par))\)$"
-NOT_ACTIVE_NO_NICKNAME_FINE = r"(?P<poke_name>.+?)$"
-NOT_ACTIVE_NO_NICKNAME = r"(?P<poke_name>.+?) \((?P<health>(.+?%(\|.+?)?|fainted|tox|brn|slp|par))\)$"
-ACTIVE_NO_NICKNAME = r"(?P<poke_name>.+) \(active\)$"
-ACTIVE_NICKNAME = r".+\((?P<poke_name>.+?)\) \(active\)$"
-
-CONDITIONS = set(["tox", "brn", "slp", "par"])
-
-class StateException(Exception):
-
-    def __init__(self, method, in_states, current_state):
-        message = "Client tried calling <{method}> method while in [{current_state}]. Appropriate states: {states}".format(
-            method=method,
-            current_state=current_state,
-            states=str(list(in_states))
+from states import StateException, require_state, state
+from metrics import Metrics, optional
+from orchestrator import BattleResult, wants_next
+from memory import tree_rss_kb
+from cache import LRUCache
+from deadline import parse_time_left
+from archive import SHOWDOWN_REPLAY_URL, REPLAY_TIMEOUT, upload_replay
+from steps import CALL, WAIT, DONE, run_steps
+
+SHOWDOWN_URL = os.environ.get('SHOWDOWN_URL', 'https://play.pokemonshowdown.com/')
+
+CONDITIONS = ["tox", "brn", "slp", "par", "psn", "frz"]
+
+ICON_TITLE = re.compile(r"""
+    ^(?:
+        (?P<nickname>.+?)\ \((?!(?:active|fainted|%(conditions)s|[\d.]+%%)[|)])(?P<species>[^()]+)\)
+      | (?P<name>.+?)
+    )
+    (?:\ \(
+        (?:
+            (?P<active>active)
+          | (?P<fainted>fainted)
+          | (?P<percent>[\d.]+)%%(?:\|(?P<percent_status>%(conditions)s))?
+          | (?P<status>%(conditions)s)
         )
-        super(StateException, self).__init__(message)
-
-def require_state(in_states):
-    if in_states is not None:
-        in_states = set(in_states)
-    def inner(func):
-        def f(self, *args, **kwargs):
-            if in_states is not None:
-                if self.get_state() not in in_states:
-                    raise StateException(func.__name__, in_states, self.get_state())
-            result = func(self, *args, **kwargs)
-            return result
-        return f
-    return inner
-
-def state(in_states, out_state):
-    if in_states is not None:
-        in_states = set(in_states)
-    def inner(func):
-        def f(self, *args, **kwargs):
-            if in_states is not None:
-                if self.get_state() not in in_states:
-                    raise StateException(func.__name__, in_states, self.get_state())
-            result = func(self, *args, **kwargs)
-            self.set_state(out_state)
-            return result
-        return f
-    return inner
-
+    \))?$
+""" % {'conditions': '|'.join(CONDITIONS)}, re.VERBOSE)
+
+TITLE_CACHE_SIZE = 4096
+
+SWITCH_BUTTONS = set(['chooseSwitch', 'chooseTeamPreview'])
+
+TURN_KEY_FUNCTION = """
+var turnKey = function() {
+    var room = window.app && app.curRoom ? app.curRoom : null;
+    if (!room || !room.battle) return null;
+    return room.battle.turn + ':' + (room.request ? room.request.rqid : '');
+};
+"""
+
+CONTROLS_SCRIPT = TURN_KEY_FUNCTION + """
+var battle = document.querySelector('.battle');
+var titles = function(bar) {
+    var trainer = battle ? battle.querySelector(bar + ' .trainer') : null;
+    var icons = trainer ? trainer.querySelectorAll('.pokemonicon') : [];
+    var result = [];
+    for (var i = 0; i < icons.length; i++) {
+        result.push(icons[i].getAttribute('title'));
+    }
+    return result;
+};
+var hptext = function(bar) {
+    var text = document.querySelector('.statbar.' + bar + ' .hptext');
+    return text ? text.textContent.trim() : null;
+};
+var request = window.app && app.curRoom ? app.curRoom.request : null;
+var side = request && request.side ? request.side.pokemon : [];
+var controls = document.querySelector('.battle-controls');
+var buttons = controls ? controls.querySelectorAll('.movemenu button, .switchmenu button') : [];
+var result = [];
+for (var i = 0; i < buttons.length; i++) {
+    var button = buttons[i];
+    var value = button.getAttribute('value');
+    var poke = button.name != 'chooseMove' ? side[parseInt(value, 10)] : null;
+    result.push({
+        name: button.getAttribute('name'),
+        value: value,
+        move: button.getAttribute('data-move'),
+        disabled: button.getAttribute('class') == 'disabled',
+        species: poke ? poke.details.split(',')[0] : button.textContent.trim()
+    });
+}
+return JSON.stringify({
+    key: turnKey(),
+    turn: window.app && app.curRoom && app.curRoom.battle ? app.curRoom.battle.turn : null,
+    icons: [titles('.leftbar'), titles('.rightbar')],
+    hp: [hptext('rstatbar'), hptext('lstatbar')],
+    buttons: result
+});
+"""
+
+CLICK_SCRIPT = """
+var name = arguments[0], value = arguments[1], mega = arguments[2];
+var controls = document.querySelector('.battle-controls');
+if (!controls) return false;
+if (mega) {
+    var toggle = controls.querySelector('input[name="megaevo"]');
+    if (toggle && !toggle.checked) toggle.click();
+}
+var button = controls.querySelector('button[name="' + name + '"][value="' + value + '"]');
+if (!button) return false;
+button.click();
+return true;
+"""
+
+EVENT_TIMEOUT = 60
+
+EVENT_SCRIPT = TURN_KEY_FUNCTION + """
+var timerSet = arguments[0], timeout = arguments[1];
+var callback = arguments[arguments.length - 1];
+var check = function() {
+    var close = document.querySelector('.ps-overlay button[name="close"]');
+    if (close) close.click();
+    if (document.querySelector('button[name="saveReplay"]')) return 'end';
+    if (!timerSet && document.querySelector('button[name="setTimer"]')) return 'timer';
+    var menu = document.querySelector('.switchmenu');
+    if (menu && menu.offsetParent !== null) return 'decision';
+    return null;
+};
+var timeLeft = function() {
+    var lines = document.querySelectorAll('.battle-log .battle-history');
+    for (var i = lines.length - 1; i >= 0 && i >= lines.length - 20; i--) {
+        if (/\d+ sec.* left|left: \d+ sec/.test(lines[i].textContent)) {
+            return {text: lines[i].textContent, index: i};
+        }
+    }
+    return null;
+};
+var event = check();
+if (event) {
+    callback({event: event, time: Date.now(), timer: timeLeft(), key: turnKey()});
+} else {
+    var observer, timer;
+    var finish = function(event) {
+        observer.disconnect();
+        clearTimeout(timer);
+        callback({event: event, time: Date.now(), timer: timeLeft(), key: turnKey()});
+    };
+    observer = new MutationObserver(function() {
+        var event = check();
+        if (event) finish(event);
+    });
+    observer.observe(document.body, {childList: true, subtree: true, attributes: true});
+    timer = setTimeout(function() { finish(null); }, timeout);
+}
+"""
+
+SEARCH_SCRIPT = """
+var timeout = arguments[0];
+var callback = arguments[arguments.length - 1];
+var overlays = document.querySelectorAll('.ps-overlay button[name="close"]');
+for (var i = 0; i < overlays.length; i++) overlays[i].click();
+var group = document.querySelector('button[name="showSearchGroup"]');
+if (group) group.click();
+var deadline = Date.now() + timeout;
+var poll = function() {
+    var button = document.querySelector('button[name="search"]');
+    if (button) {
+        button.click();
+        callback(true);
+    } else if (Date.now() > deadline) {
+        callback(false);
+    } else {
+        setTimeout(poll, 50);
+    }
+};
+poll();
+"""
+
+FINISH_SCRIPT = """
+var message = arguments[0], search = arguments[1], capture = arguments[2];
+var room = window.app && app.curRoom ? app.curRoom : null;
+var battle = room ? room.battle : null;
+var lines = document.querySelectorAll('.battle-log .battle-history');
+var winner = null, text = [];
+for (var i = lines.length - 1; i >= 0 && winner === null; i--) {
+    var match = /^(.+) won the battle!$/.exec(lines[i].textContent.trim());
+    if (match) winner = match[1];
+}
+var log;
+if (battle && battle.stepQueue) {
+    log = battle.stepQueue.join('\\n');
+} else {
+    for (var i = 0; i < lines.length; i++) text.push(lines[i].textContent);
+    log = text.join('\\n');
+}
+var result = {turn: battle ? battle.turn : null, winner: winner, log: log, searching: false, replays: []};
+if (message && room && room.send) room.send(message);
+if (capture && window.app && app.on && room && room.send) {
+    if (!window.savedReplays) {
+        window.savedReplays = [];
+        app.off('response:savereplay');
+        app.on('response:savereplay', function(replay) {
+            window.savedReplays.push(replay);
+            if (window.replayWaiter) window.replayWaiter();
+        });
+    }
+    room.send('/savereplay');
+    result.replays = window.savedReplays.splice(0);
+} else {
+    var save = document.querySelector('button[name="saveReplay"]');
+    if (save) save.click();
+}
+var closers = document.querySelectorAll('.closebutton');
+for (var i = 0; i < closers.length; i++) closers[i].click();
+var home = document.querySelector('[href="/"].button.roomtab');
+if (home) home.click();
+if (search) {
+    var button = document.querySelector('button[name="search"]');
+    if (button) {
+        button.click();
+        result.searching = true;
+    }
+}
+return result;
+"""
+
+REPLAYS_SCRIPT = """
+var timeout = arguments[0];
+var callback = arguments[arguments.length - 1];
+var replays = window.savedReplays || [];
+if (replays.length || !timeout) {
+    callback(replays.splice(0));
+} else {
+    var timer = setTimeout(function() {
+        window.replayWaiter = null;
+        callback(replays.splice(0));
+    }, timeout);
+    window.replayWaiter = function() {
+        window.replayWaiter = null;
+        clearTimeout(timer);
+        callback(replays.splice(0));
+    };
+}
+"""
+
+RESTORE_STORAGE_SCRIPT = """
+var items = JSON.parse(arguments[0]);
+for (var key in items) {
+    localStorage.setItem(key, items[key]);
+}
+"""
+
+COOKIE_FIELDS = ['name', 'value', 'path', 'secure', 'expiry']
+
+title_cache = LRUCache(TITLE_CACHE_SIZE)
+
+def parse_icon_title(text):
+    """
+    Parses the title of a team icon into (poke_name, active, faint, health,
+    status). health is None for an active Pokemon, whose HP is shown in its
+    statbar. Titles repeat from turn to turn, so results are cached.
+    """
+    parsed = title_cache.get(text)
+    if parsed is None:
+        match = ICON_TITLE.match(text)
+        if match is None:
+            parsed = (text, False, False, 1.0, None)
+        else:
+            poke_name = match.group('species') or match.group('name')
+            if match.group('active'):
+                parsed = (poke_name, True, False, None, None)
+            elif match.group('fainted'):
+                parsed = (poke_name, False, True, 0.0, None)
+            elif match.group('percent'):
+                parsed = (poke_name, False, False, float(match.group('percent')) / 100.0,
+                          match.group('percent_status'))
+            else:
+                parsed = (poke_name, False, False, 1.0, match.group('status'))
+        title_cache.put(text, parsed)
+    return parsed
 
 class ShowdownClient(object):
 
-    def __init__(self, agent, browser='firefox', url=SHOWDOWN_URL, username=None, password=None):
+    def __init__(self, agent, browser='firefox', url=SHOWDOWN_URL, username=None, password=None,
+                 metrics=None, profiler=None, archiver=None, recorder=None, scheduler=None,
+                 replay_url=SHOWDOWN_REPLAY_URL):
         self.agent = agent
         self.browser = browser
         self.start_url = url
+        self.replay_url = replay_url
         self.state = None
         self.username = username
         self.password = password
+        self.controls = None
+        self.turn_key = None
+        self.battle_id = None
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler
+        self.archiver = archiver
+        self.recorder = recorder
+        self.scheduler = scheduler
+        self.time_left = None
+        self.time_left_at = None
+        self.timer_line = None
+        self.searching = False
+        self.wake_latency = self.metrics.histogram('wake_latency_ms')
+        self.reaction_latency = self.metrics.histogram('reaction_latency_ms')
 
 
         if self.browser == 'firefox':
@@ -75,6 +308,15 @@ class ShowdownClient(object):
         elif self.browser == 'phantomjs':
             self.driver = webdriver.PhantomJS()
             self.driver.set_window_size(1920, 1080)
+        self.count_driver_calls()
+        self.driver.set_script_timeout(EVENT_TIMEOUT + 5)
+
+    def count_driver_calls(self):
+        execute = self.driver.execute
+        def counted(command, params=None):
+            self.metrics.count_call()
+            return execute(command, params)
+        self.driver.execute = counted
 
     def get_state(self):
         return self.state
@@ -111,6 +353,35 @@ class ShowdownClient(object):
         except:
             return None
 
+    def wait_for_event(self, timeout, timer_set):
+        """
+        Blocks until the page requests a decision, shows the timer button or
+        ends the battle, and returns the event with the time the page saw it.
+        """
+        result = self.driver.execute_async_script(EVENT_SCRIPT, timer_set, int(timeout * 1000))
+        self.update_time_left(result['timer'])
+        self.turn_key = result['key']
+        return result['event'], result['time'] / 1000.0
+
+    def update_time_left(self, timer):
+        """
+        Takes the last timer message in the log. Its time only counts from
+        when a message is first seen, so one left over from an earlier turn
+        keeps counting down in get_time_left.
+        """
+        if timer is None:
+            return
+        line = (timer['index'], timer['text'])
+        if line != self.timer_line:
+            self.timer_line = line
+            self.time_left = parse_time_left(timer['text'])
+            self.time_left_at = time.time()
+
+    def get_time_left(self):
+        if self.time_left is None:
+            return None
+        return self.time_left - (time.time() - self.time_left_at)
+
     def selector(self, string, elem=None):
         try:
             elem = elem or self.driver
@@ -126,10 +397,51 @@ class ShowdownClient(object):
             pass
 
     @state(None, 'homepage')
-    def start(self):
+    def start(self, clear_storage=True):
         logging.info("Starting driver...")
         self.driver.get(self.start_url)
-        self.driver.execute_script("localStorage.clear();")
+        if clear_storage:
+            self.driver.execute_script("localStorage.clear();")
+
+    def save_session(self):
+        """
+        Returns the page's cookies and localStorage, which hold the login
+        and the imported teams, so a new browser can pick up where this one
+        left off.
+        """
+        return {
+            'cookies': self.driver.get_cookies(),
+            'storage': json.loads(self.driver.execute_script("return JSON.stringify(localStorage);")),
+        }
+
+    @state(['homepage'], 'homepage')
+    def restore_session(self, session):
+        logging.info("Restoring saved session...")
+        for cookie in session['cookies']:
+            self.driver.add_cookie(dict((key, cookie[key]) for key in COOKIE_FIELDS if key in cookie))
+        self.driver.execute_script(RESTORE_STORAGE_SCRIPT, json.dumps(session['storage']))
+        self.driver.refresh()
+
+    def ping(self):
+        return self.driver.execute_script("return 1;") == 1
+
+    def get_browser_pid(self):
+        service = getattr(self.driver, 'service', None)
+        if service is not None and getattr(service, 'process', None) is not None:
+            return service.process.pid
+        binary = getattr(self.driver, 'binary', None)
+        if binary is not None and getattr(binary, 'process', None) is not None:
+            return binary.process.pid
+        return None
+
+    def get_memory_usage(self):
+        """
+        Resident memory of the browser and its child processes in bytes.
+        """
+        pid = self.get_browser_pid()
+        if pid is None:
+            return 0
+        return tree_rss_kb(pid) * 1024
 
     @state(None, 'stopped')
     def stop(self):
@@ -148,6 +460,10 @@ class ShowdownClient(object):
         password = password or self.password
         logging.info("Logging in as %s..." % username)
         choose_button = self.wait('button[name="login"]', 3)
+        if choose_button is None:
+            logging.info("Already logged in, keeping session...")
+            self.username = username
+            return
         choose_button.click()
 
         popup = self.selector('.ps-popup')
@@ -230,75 +546,62 @@ class ShowdownClient(object):
         logging.info("Selecting team tier...")
         self.select_format(tier, team=True)
 
+    def get_controls(self):
+        """
+        The team icons, HP texts and control buttons of the current decision,
+        read in one script call and kept until the turn or request id seen by
+        wait_for_event changes, or until an action is performed.
+        """
+        if self.controls is None or self.controls['key'] != self.turn_key:
+            self.controls = json.loads(self.driver.execute_script(CONTROLS_SCRIPT))
+            self.turn_key = self.controls['key']
+        return self.controls
+
+    def invalidate_controls(self):
+        self.controls = None
+
     @require_state(['start_battle', 'battle_main'])
     def get_legal_actions(self):
         actions = []
-        battle = self.selector('.battle-controls')
-
-        move_menu = self.selector('.movemenu', battle)
-        if move_menu is not None:
-            move_buttons = self.selectors('button', move_menu)
-            for i, button in enumerate(move_buttons):
-                if button.get_attribute('name') == "chooseMove":
-                    if button.get_attribute('class') != "disabled":
-                        actions.append(Move(button.get_attribute('data-move')))
-
-        switch_menu = self.selector('.switchmenu', battle)
-        switch_buttons = self.selectors('button', switch_menu)
-        for button in switch_buttons:
-            if button.get_attribute('name') in ['chooseSwitch', 'chooseTeamPreview']:
-                if button.get_attribute('class') != "disabled":
-                    hov = ActionChains(self.driver).move_to_element(button)
-                    hov.perform()
-                    tooltip = self.selector("#tooltipwrapper")
-                    text = self.selector('h2', tooltip).text
-                    match = re.match(r".+ \((?P<pokename>.+?)\)", text)
-                    if match:
-                        pokename = match.group('pokename')
-                    else:
-                        pokename = text
-                    actions.append(Switch(pokename))
+        buttons = self.get_controls()['buttons']
+        for button in buttons:
+            if button['name'] == "chooseMove":
+                if not button['disabled']:
+                    actions.append(Move(button['move']))
+        for button in buttons:
+            if button['name'] in SWITCH_BUTTONS and not button['disabled']:
+                actions.append(Switch(button['species']))
         return actions
 
+    def find_button(self, action):
+        for button in self.get_controls()['buttons']:
+            if button['disabled']:
+                continue
+            if action.is_move():
+                if button['name'] == "chooseMove" and button['move'] == action.get_name():
+                    return button
+            elif button['name'] in SWITCH_BUTTONS and button['species'] == action.get_name():
+                return button
+        return None
+
     @require_state(['start_battle', 'battle_main'])
     def perform_action(self, action):
-        battle = self.selector('.battle-controls')
-        megaevo = self.selector('input[name="megaevo"]')
-        if megaevo is not None:
-            megaevo.click()
-        if action.is_move():
-            move_menu = self.selector('.movemenu', battle)
-            if move_menu is not None:
-                move_buttons = self.selectors('button', move_menu)
-                for i, button in enumerate(move_buttons):
-                    if button.get_attribute('name') == "chooseMove":
-                        if button.get_attribute('data-move') == action.get_name():
-                            button.click()
-                            return True
-        if action.is_switch():
-            poke_name = action.get_name()
-            switch_menu = self.selector('.switchmenu', battle)
-            switch_buttons = self.selectors('button', switch_menu)
-            for i, button in enumerate(switch_buttons):
-                hov = ActionChains(self.driver).move_to_element(button)
-                hov.perform()
-                tooltip = self.selector("#tooltipwrapper")
-                text = self.selector('h2', tooltip).text
-                match = re.match(r".+ \((?P<pokename>.+?)\)", text)
-                if match:
-                    pokename = match.group('pokename')
-                else:
-                    pokename = text
-                if pokename == poke_name:
-                    button.click()
-                    return True
-        return False
+        """
+        Clicks the button for action, after the mega evolution toggle if it
+        is a move, in a single script call.
+        """
+        button = self.find_button(action)
+        if button is None:
+            return False
+        if not self.driver.execute_script(CLICK_SCRIPT, button['name'], button['value'], action.is_move()):
+            return False
+        self.invalidate_controls()
+        return True
 
     @state(['homepage'], 'homepage')
     def play(self, n_iters):
         logging.info("Playing %u battles..." % n_iters)
-        for i in xrange(n_iters):
-            self.battle()
+        return [self.battle(search_next=i + 1 < n_iters) for i in xrange(n_iters)]
 
     @state(['start_battle'], 'battle_main')
     def select_initial(self):
@@ -306,122 +609,138 @@ class ShowdownClient(object):
 
     @require_state(['start_battle', 'battle_main'])
     def get_gamestate(self):
-        battle = self.selector('.battle')
-        my_trainer = self.selector('.trainer', self.selector('.leftbar', battle))
-        opp_trainer = self.selector('.trainer', self.selector('.rightbar', battle))
+        snapshot = self.get_controls()
         teams = ([], [])
         primary = [None, None]
-        for i, icons in enumerate([self.selectors('.pokemonicon', my_trainer),
-                                                     self.selectors('.pokemonicon', opp_trainer)]):
-            for icon in icons:
-                text = icon.get_attribute('title')
-                if re.match(ACTIVE_NICKNAME, text):
-                    match = re.match(ACTIVE_NICKNAME, text)
-                    poke_name = match.group('poke_name')
-                    faint = False
-                    if i == 0:
-                        statbar = self.selector('.statbar.rstatbar')
-                    else:
-                        statbar = self.selector('.statbar.lstatbar')
-                    percent = self.selector('.hptext', statbar).text
-                    primary[i] = poke_name
-                elif re.match(ACTIVE_NO_NICKNAME, text):
-                    match = re.match(ACTIVE_NO_NICKNAME, text)
-                    poke_name = match.group('poke_name')
-                    faint = False
-                    if i == 0:
-                        statbar = self.selector('.statbar.rstatbar')
-                    else:
-                        statbar = self.selector('.statbar.lstatbar')
-                    percent = self.selector('.hptext', statbar).text
+        for i, titles in enumerate(snapshot['icons']):
+            for text in titles:
+                poke_name, active, faint, health, status = parse_icon_title(text)
+                if active:
+                    health = float((snapshot['hp'][i] or '100%')[:-1]) / 100.0
                     primary[i] = poke_name
-                elif re.match(NOT_ACTIVE_NICKNAME, text):
-                    match = re.match(NOT_ACTIVE_NICKNAME, text)
-                    poke_name = match.group('poke_name')
-                    if match.group('health') == 'fainted':
-                        faint = True
-                        percent = '0%'
-                    else:
-                        faint = False
-                        percent = match.group('health').split('|')[0]
-                        if percent in CONDITIONS:
-                            percent = '100%'
-                elif re.match(NOT_ACTIVE_NO_NICKNAME, text):
-                    match = re.match(NOT_ACTIVE_NO_NICKNAME, text)
-                    poke_name = match.group('poke_name')
-                    if match.group('health') == 'fainted':
-                        faint = True
-                        percent = '0%'
-                    else:
-                        faint = False
-                        percent = match.group('health').split('|')[0]
-                        if percent in CONDITIONS:
-                            percent = '100%'
-                elif re.match(NOT_ACTIVE_NICKNAME_FINE, text):
-                    match = re.match(NOT_ACTIVE_NICKNAME_FINE, text)
-                    poke_name = match.group('poke_name')
-                    faint = False
-                    percent = '100%'
-                else:
-                    poke_name = text
-                    faint = False
-                    percent = '100%'
-                health = float(percent[:-1]) / 100.0
                 poke = Pokemon(poke_name, faint=faint, health=health)
+                poke.status = status
                 teams[i].append(poke)
         gamestate = Gamestate(teams=teams)
         for i, p in enumerate(primary):
             if p is not None:
                 gamestate.set_primary(i, p)
+        gamestate.battle_id = self.battle_id
+        gamestate.turn = snapshot['turn']
         return gamestate
 
+    def choose_action(self, gamestate, actions, initial):
+        if self.scheduler is None:
+            return self.agent.get_action(gamestate, actions, initial=initial)
+        return self.scheduler.get_action(self.agent, gamestate, actions, initial=initial,
+                                         time_left=self.get_time_left())
+
     def make_action(self, initial=False):
-        gamestate = self.get_gamestate()
-        actions = self.get_legal_actions()
-        selected_action = self.agent.get_action(gamestate, actions, initial=initial)
-        for action in actions:
-            if action == selected_action:
-                self.perform_action(action)
+        profile = self.profiler.profile(self.battle_id) if self.profiler is not None else None
+        with optional(profile), self.metrics.span('turn'):
+            with self.metrics.span('get_gamestate'):
+                gamestate = self.get_gamestate()
+            with self.metrics.span('get_legal_actions'):
+                actions = self.get_legal_actions()
+            with self.metrics.span('get_action'):
+                selected_action = self.choose_action(gamestate, actions, initial)
+            with self.metrics.span('perform_action'):
+                for action in actions:
+                    if action == selected_action:
+                        self.perform_action(action)
+        if self.recorder is not None:
+            self.recorder.record(self.battle_id, gamestate, actions, selected_action,
+                                 encoded=getattr(gamestate, 'encoded', None))
 
     @state(['homepage'], 'homepage')
-    def battle(self):
-        logging.info("Searching for battle...")
-        add_button = self.selector('button[name="showSearchGroup"]')
-        if add_button is not None:
-            try:
-                add_button.click()
-            except:
-                pass
-        search_button = self.wait('button[name="search"]', 5)
-        search_button.click()
-        battle_controls = self.wait('.battle-controls', 60)
-        logging.info("Battle started: %s" % self.driver.current_url)
+    def battle(self, search_next=False):
+        """
+        Plays one battle by running battle_steps' calls in this thread.
+        """
+        return run_steps(self.battle_steps(search_next))
+
+    def battle_steps(self, search_next=False):
+        """
+        The body of battle as a generator. Every blocking driver or agent
+        call is yielded as (CALL, function), or (WAIT, function) for the
+        waits on the page that can take up to a minute, and the function's
+        result is sent back; the last item is (DONE, result). battle runs
+        the calls in place, AsyncShowdownClient on executors, so both play
+        the same battle. Spans around a yield are step spans, since the
+        calls they time may run on another thread. The battle is closed in a single script call that
+        also asks for the replay and with search_next queues the search for
+        the following battle. Without an archiver the page uploads the
+        replay itself. With one, the page keeps the server's answer and the
+        archiver uploads it with retries: answers are collected by the next
+        battle's closing call, and the last battle of a run waits for its
+        own, at most REPLAY_TIMEOUT seconds.
+        """
+        with self.metrics.step_span('wait_battle') as span:
+            if not self.searching:
+                logging.info("Searching for battle...")
+                found = yield WAIT, span.counted(partial(self.driver.execute_async_script, SEARCH_SCRIPT, 5000))
+                if not found:
+                    raise RuntimeError("Search button did not appear")
+            self.searching = False
+            battle_controls = yield WAIT, span.counted(partial(self.wait, '.battle-controls', 60))
+        self.battle_id = yield CALL, partial(getattr, self.driver, 'current_url')
+        logging.info("Battle started: %s" % self.battle_id)
+        start = time.time()
+        decisions = 0
+        self.invalidate_controls()
+        self.time_left = self.timer_line = None
         self.set_state('start_battle')
-        self.chat('gl hf')
-        what_do = self.selector('.whatdo', battle_controls)
-        if what_do is not None and what_do.text == 'How will you start the battle?':
-            self.select_initial()
-        save_replay = self.selector('button[name="saveReplay"]')
+        yield CALL, partial(self.chat, 'gl hf')
+        if (yield CALL, partial(self.is_team_preview, battle_controls)):
+            yield CALL, self.select_initial
         start_timer = False
-        while save_replay is None:
-            while not self.wait('.switchmenu', 1) and save_replay is None:
-                timer = self.selector('button[name="setTimer"]')
-                if timer is not None and not start_timer:
-                    start_timer = True
-                    timer.click()
-                save_replay = self.selector('button[name="saveReplay"]')
-            if save_replay is None:
-                self.make_action()
-        self.chat('gg')
-        save_replay = self.selector('button[name="saveReplay"]')
-        save_replay.click()
+        while True:
+            with self.metrics.step_span('wait_event') as span:
+                event, event_time = yield WAIT, span.counted(partial(self.wait_for_event, EVENT_TIMEOUT, start_timer))
+            if event == 'end':
+                break
+            elif event == 'timer':
+                start_timer = True
+                yield CALL, self.set_timer
+            elif event == 'decision':
+                self.wake_latency.record((time.time() - event_time) * 1000.0)
+                yield CALL, self.make_action
+                decisions += 1
+                self.reaction_latency.record((time.time() - event_time) * 1000.0)
+        logging.info("Wake latency (ms): %s" % self.wake_latency)
+        logging.info("Reaction latency (ms): %s" % self.reaction_latency)
         logging.info("Battle complete! Saving replay...")
-        overlay = self.wait('.ps-overlay', 60)
-        close_button = self.selector('button[name="close"]', overlay)
-        close_button.click()
-
-        close_buttons = self.selectors(".closebutton")
-        while len(close_buttons) > 0:
-            close_buttons[0].click()
-            close_buttons = self.selectors(".closebutton")
-        self.home()
+        with self.metrics.step_span('end_battle') as span:
+            outcome = yield CALL, span.counted(partial(self.driver.execute_script, FINISH_SCRIPT, 'gg',
+                                                       wants_next(search_next), self.archiver is not None))
+        if self.archiver is not None and not outcome['searching']:
+            replays = yield WAIT, partial(self.driver.execute_async_script, REPLAYS_SCRIPT, REPLAY_TIMEOUT * 1000)
+            outcome['replays'].extend(replays)
+        result = yield CALL, partial(self.finish_battle, outcome, start, decisions)
+        yield DONE, result
+
+    def is_team_preview(self, battle_controls):
+        what_do = self.selector('.whatdo', battle_controls)
+        return what_do is not None and what_do.text == 'How will you start the battle?'
+
+    def set_timer(self):
+        self.selector('button[name="setTimer"]').click()
+
+    def finish_battle(self, outcome, start, decisions):
+        """
+        Builds the BattleResult from FINISH_SCRIPT's outcome and hands the
+        battle and any replays the page collected to the recorder and
+        archiver.
+        """
+        self.searching = outcome['searching']
+        result = BattleResult(self.battle_id,
+                              None if outcome['winner'] is None else outcome['winner'] == self.username,
+                              outcome['turn'] or decisions,
+                              time.time() - start)
+        if self.recorder is not None:
+            self.recorder.finish(self.battle_id, result.won)
+        if self.archiver is not None:
+            self.archiver.submit(self.battle_id, log=outcome['log'], result=result)
+            for replay in outcome['replays']:
+                self.archiver.submit(replay['id'], upload=partial(upload_replay, self.replay_url, replay))
+        return result
@@ -0,0 +1,74 @@
+import re
+import time
+import logging
+import threading
+
+from metrics import Metrics
+
+TIME_LEFT = re.compile(r'(\d+) sec(?:onds)?(?: this turn| left)')
+
+def parse_time_left(text):
+    """
+    Reads the seconds left this turn from a timer message, e.g. "Time left:
+    150 sec this turn | 270 sec total" or "bot has 30 seconds left.".
+    """
+    match = TIME_LEFT.search(text or '')
+    if match is None:
+        return None
+    return float(match.group(1))
+
+class DeadlineScheduler(object):
+    """
+    Runs agent.get_action_by in a worker thread with a per-turn budget: at
+    most budget seconds, and no more than the turn timer's time_left minus
+    margin unless that leaves less than min_budget. If the agent has not
+    answered when the budget runs out, or is still stuck on an earlier turn,
+    the agent's cheap fallback_action is played instead and the miss is
+    counted in metrics.
+
+    Holds one worker at a time, so each client needs its own scheduler.
+    """
+
+    def __init__(self, budget=10.0, margin=5.0, min_budget=0.5, grace=0.05, metrics=None):
+        self.budget = budget
+        self.margin = margin
+        self.min_budget = min_budget
+        self.grace = grace
+        self.metrics = metrics or Metrics()
+        self.budgets = self.metrics.histogram('decision_budget_ms')
+        self.worker = None
+
+    def get_budget(self, time_left=None):
+        if time_left is None:
+            return self.budget
+        return min(self.budget, max(self.min_budget, time_left - self.margin))
+
+    def get_action(self, agent, gamestate, legal_actions, initial=False, time_left=None):
+        budget = self.get_budget(time_left)
+        self.budgets.record(budget * 1000.0)
+        deadline = time.time() + budget
+        fallback = agent.fallback_action(gamestate, legal_actions)
+        if self.worker is not None and self.worker.is_alive():
+            logging.warning("Agent is still busy with an earlier turn, playing %s" % fallback)
+            self.metrics.increment('deadline_busy')
+            return fallback
+
+        outcome = {}
+        def decide():
+            try:
+                outcome['action'] = agent.get_action_by(deadline - self.grace, gamestate, legal_actions,
+                                                        initial=initial)
+            except Exception:
+                logging.exception("Agent failed, playing the fallback action")
+        self.worker = threading.Thread(target=decide)
+        self.worker.daemon = True
+        self.worker.start()
+        self.worker.join(max(0.0, deadline - time.time()))
+        if self.worker.is_alive():
+            logging.warning("Agent missed its %.1fs budget, playing %s" % (budget, fallback))
+            self.metrics.increment('deadline_misses')
+            return fallback
+        if 'action' not in outcome:
+            self.metrics.increment('agent_errors')
+        action = outcome.get('action')
+        return fallback if action is None else action
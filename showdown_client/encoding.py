@@ -0,0 +1,193 @@
+import copy
+import logging
+import threading
+
+import numpy as np
+
+from cache import LRUCache
+
+class EncodingMismatch(Exception):
+    pass
+
+def get_signature(state):
+    """
+    Maps (side, species) to (health, faint, primary, status) for every
+    Pokemon in the gamestate.
+    """
+    signature = {}
+    for side in xrange(2):
+        team = state.get_team(side)
+        if not team:
+            continue
+        primary = state.get_primary(side).get_name()
+        for poke in team:
+            signature[(side, poke.get_name())] = (poke.health, poke.faint, poke.get_name() == primary,
+                                                  getattr(poke, 'status', None))
+    return signature
+
+def diff(a, b):
+    return set(np.flatnonzero(a != b).tolist())
+
+class Layout(object):
+    """
+    The features of one (side, species): their indices in the state vector
+    and which of them hold the Pokemon's health verbatim.
+    """
+
+    def __init__(self, indices, health_mask):
+        self.indices = indices
+        self.health_mask = health_mask
+
+class BattleEncoding(object):
+    """
+    One battle's last signature, vector and roster, the frozenset of
+    (side, species) in it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.signature = None
+        self.vector = None
+        self.roster = None
+
+class IncrementalEncoder(object):
+    """
+    Wraps converter.encode_state. Keeps the last feature vector of every
+    battle and, when only some Pokemon changed health, faint, primary or
+    status condition, rewrites just those Pokemon's features.
+
+    Which features belong to a Pokemon is learned by probing the converter
+    the first time that species changes. Patching assumes each feature
+    depends on a single Pokemon and holds either its health or a value fixed
+    by (faint, primary, status); Pokemon whose features break that assumption
+    are always re-encoded in full, as is any state where a status changed.
+    Layouts are shared by all battles and learned under a lock; the values
+    patched in are keyed on the battle's roster as well, since a feature may
+    also depend on who else is on either team. With debug=True every vector
+    is checked bit-for-bit against encode_state and EncodingMismatch is
+    raised on any difference.
+    """
+
+    def __init__(self, converter, debug=False, max_battles=64, max_templates=10000):
+        self.converter = converter
+        self.debug = debug
+        self.battles = LRUCache(max_battles)
+        self.templates = LRUCache(max_templates)
+        self.layouts = {}
+        self.owners = {}
+        self.tainted = set()
+        self.lock = threading.Lock()
+        self.full_encodes = 0
+        self.patches = 0
+
+    def encode_state(self, state, battle_id=None):
+        if battle_id is None:
+            return self.converter.encode_state(state)
+        battle = self.battles.get(battle_id)
+        if battle is None:
+            battle = BattleEncoding()
+            self.battles.put(battle_id, battle)
+        with battle.lock:
+            signature = get_signature(state)
+            vector, changed = None, ()
+            if battle.vector is not None:
+                vector, changed = self.patch(battle, signature)
+            if vector is None:
+                battle.roster = frozenset(signature)
+                vector = self.encode_full(battle, state, signature, changed)
+            if self.debug:
+                expected = self.converter.encode_state(state)
+                if vector.dtype != expected.dtype or vector.tobytes() != expected.tobytes():
+                    raise EncodingMismatch("Incremental encoding differs from encode_state in %s" % battle_id)
+            battle.signature, battle.vector = signature, vector
+        return vector
+
+    def finish(self, battle_id):
+        self.battles.pop(battle_id)
+
+    def patch(self, battle, signature):
+        last_signature = battle.signature
+        if set(signature) != set(last_signature):
+            return None, ()
+        changed = [key for key in signature if signature[key] != last_signature[key]]
+        with self.lock:
+            layouts = [(key, self.layouts.get(key), key in self.tainted) for key in changed]
+        vector = battle.vector.copy()
+        for key, layout, tainted in layouts:
+            if layout is None or tainted or signature[key][3] != last_signature[key][3]:
+                return None, changed
+            health, faint, primary, status = signature[key]
+            template = self.templates.get((battle.roster,) + key + (faint, primary, status))
+            if template is None:
+                return None, changed
+            values = template.copy()
+            values[layout.health_mask] = health
+            vector[layout.indices] = values
+        self.patches += 1
+        return vector, changed
+
+    def encode_full(self, battle, state, signature, changed):
+        vector = self.converter.encode_state(state)
+        self.full_encodes += 1
+        with self.lock:
+            for key in changed:
+                if key not in self.layouts:
+                    self.learn(state, vector, key, signature)
+            layouts = dict((key, self.layouts.get(key)) for key in signature)
+        for key, (health, faint, primary, status) in signature.items():
+            layout = layouts[key]
+            if layout is not None:
+                self.templates.put((battle.roster,) + key + (faint, primary, status), vector[layout.indices])
+        return vector
+
+    def probe(self, state, side, species, health=None, faint=None, primary=None):
+        probe = copy.deepcopy(state)
+        if health is not None:
+            for poke in probe.get_team(side):
+                if poke.get_name() == species:
+                    poke.health = health
+                    poke.faint = faint
+        if primary is not None:
+            probe.set_primary(side, primary)
+        return self.converter.encode_state(probe)
+
+    def learn(self, state, vector, key, signature):
+        side, species = key
+        health, faint, primary, status = signature[key]
+        logging.debug("Learning feature layout of %s on side %u..." % (species, side))
+
+        health_a = 0.25 if health == 0.5 else 0.5
+        health_b = 0.8 if health == 0.75 else 0.75
+        probe_a = self.probe(state, side, species, health=health_a, faint=False)
+        probe_b = self.probe(state, side, species, health=health_b, faint=False)
+        health_indices = diff(vector, probe_a) | diff(vector, probe_b)
+        health_mask = set(i for i in health_indices
+                          if probe_a[i] == probe_a.dtype.type(health_a) and probe_b[i] == probe_b.dtype.type(health_b))
+        indices = set(health_indices)
+        if health_mask != health_indices:
+            self.tainted.add(key)
+
+        probe = self.probe(state, side, species, health=1.0 if faint else 0.0, faint=not faint)
+        indices |= diff(vector, probe)
+        fainted, fainted_health = (vector, health) if faint else (probe, 0.0)
+        if any(fainted[i] != fainted.dtype.type(fainted_health) for i in health_mask):
+            self.tainted.add(key)
+
+        others = [name for (s, name) in signature if s == side and name != species]
+        if len(others) >= 2:
+            with_self = self.probe(state, side, species, primary=species)
+            with_first = self.probe(state, side, species, primary=others[0])
+            with_second = self.probe(state, side, species, primary=others[1])
+            indices |= diff(with_self, with_first) & diff(with_self, with_second)
+            if health_mask & (diff(with_self, with_first) | diff(with_self, with_second)):
+                self.tainted.add(key)
+        else:
+            self.tainted.add(key)
+
+        for index in indices:
+            owner = self.owners.setdefault(index, key)
+            if owner != key:
+                self.tainted.update([owner, key])
+
+        indices = np.array(sorted(indices), dtype=int)
+        self.layouts[key] = Layout(indices, np.array([i in health_mask for i in indices], dtype=bool))
@@ -0,0 +1,99 @@
+import time
+import logging
+import threading
+from Queue import Queue, Empty
+
+import numpy as np
+
+from metrics import Histogram
+
+class InferenceRequest(object):
+
+    def __init__(self, x):
+        self.x = x
+        self.enqueued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class InferenceServer(object):
+    """
+    Collects encoded states from many battles and runs them through the
+    network together. A batch is sent as soon as it holds max_batch_size
+    states or max_wait seconds have passed since its first state arrived.
+    """
+
+    def __init__(self, net, max_batch_size=32, max_wait=0.005):
+        self.net = net
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = None
+        self.batch_size = Histogram(buckets=range(1, max_batch_size + 1))
+        self.queue_delay = Histogram()
+
+    def start(self):
+        logging.info("Starting inference server (batch size %u, wait %.1fms)..." % (self.max_batch_size,
+                                                                                   self.max_wait * 1000.0))
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def predict(self, x):
+        request = InferenceRequest(x)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def serve(self):
+        stopping = False
+        while not stopping:
+            request = self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        now = time.time()
+        for request in batch:
+            self.queue_delay.record((now - request.enqueued) * 1000.0)
+        self.batch_size.record(len(batch))
+        try:
+            output = self.net.predict(np.stack([request.x for request in batch]))
+            for request, row in zip(batch, output):
+                request.result = row
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        mean_size = self.batch_size.mean()
+        return {
+            'batch_size': self.batch_size.summary(),
+            'batch_fill': mean_size / self.max_batch_size if mean_size is not None else None,
+            'queue_delay_ms': self.queue_delay.summary(),
+        }
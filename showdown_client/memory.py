@@ -0,0 +1,34 @@
+import os
+
+def rss_kb(pid):
+    try:
+        with open('/proc/%u/status' % pid) as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def child_pids(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as fp:
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+def tree_rss_kb(pid):
+    """
+    Resident memory of a process and all of its descendants, read from
+    /proc. Returns 0 where /proc is not available.
+    """
+    if not os.path.isdir('/proc'):
+        return 0
+    return rss_kb(pid) + sum(tree_rss_kb(child) for child in child_pids(pid))
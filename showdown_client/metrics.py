@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import heapq
+import bisect
+import pstats
+import cProfile
+import logging
+import threading
+from StringIO import StringIO
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+CALL_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram. Memory stays constant no matter how many values
+    are recorded; percentiles are reported as bucket upper bounds.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.lock = threading.Lock()
+
+    def record(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.total += value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+    def __str__(self):
+        if self.count == 0:
+            return "n=0"
+        return "n=%u mean=%.1f p50<=%.1f p90<=%.1f p99<=%.1f max=%.1f" % (self.count, self.mean(),
+                                                                         self.percentile(0.5),
+                                                                         self.percentile(0.9),
+                                                                         self.percentile(0.99),
+                                                                         self.max)
+
+class StepSpan(object):
+    """
+    The driver calls of a Metrics.step_span: those made by the functions
+    wrapped with counted, on whichever thread they run.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.calls = 0
+
+    def counted(self, func):
+        def call():
+            before = getattr(self.metrics.local, 'calls', 0)
+            try:
+                return func()
+            finally:
+                self.calls += getattr(self.metrics.local, 'calls', 0) - before
+        return call
+
+class Metrics(object):
+    """
+    Named histograms and counters shared by the clients of one process.
+    Spans time a block of code and count the driver calls made inside it.
+    A block of a step generator may have its calls run on other threads,
+    so it uses step_span, which counts only the calls of the steps wrapped
+    with its counted.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets=buckets)
+            return self.histograms[name]
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_call(self):
+        self.local.calls = getattr(self.local, 'calls', 0) + 1
+        self.increment('driver_calls')
+
+    @contextmanager
+    def span(self, name):
+        calls = getattr(self.local, 'calls', 0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.histogram('%s_ms' % name).record((time.time() - start) * 1000.0)
+            self.histogram('%s_driver_calls' % name, CALL_BUCKETS).record(getattr(self.local, 'calls', 0) - calls)
+
+    @contextmanager
+    def step_span(self, name):
+        span = StepSpan(self)
+        start = time.time()
+        try:
+            yield span
+        finally:
+            self.histogram('%s_ms' % name).record((time.time() - start) * 1000.0)
+            self.histogram('%s_driver_calls' % name, CALL_BUCKETS).record(span.calls)
+
+    def to_json_lines(self):
+        lines = []
+        timestamp = time.time()
+        for name, histogram in sorted(self.histograms.items()):
+            line = {'metric': name, 'type': 'histogram', 'time': timestamp}
+            line.update(histogram.summary())
+            lines.append(json.dumps(line, sort_keys=True))
+        for name, value in sorted(self.counters.items()):
+            lines.append(json.dumps({'metric': name, 'type': 'counter', 'time': timestamp, 'value': value},
+                                    sort_keys=True))
+        return '\n'.join(lines) + '\n'
+
+    def to_prometheus(self, prefix='showdown_'):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            name = prefix + name
+            lines.append('# TYPE %s histogram' % name)
+            seen = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                seen += count
+                lines.append('%s_bucket{le="%s"} %u' % (name, bound, seen))
+            lines.append('%s_bucket{le="+Inf"} %u' % (name, histogram.count))
+            lines.append('%s_sum %s' % (name, histogram.total))
+            lines.append('%s_count %u' % (name, histogram.count))
+        for name, value in sorted(self.counters.items()):
+            name = prefix + name
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='jsonl'):
+        if format == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            text = self.to_json_lines()
+        with open(path, 'a' if format == 'jsonl' else 'w') as fp:
+            fp.write(text)
+
+class TurnProfiler(object):
+    """
+    Runs every turn under cProfile and keeps the profiles of the n slowest.
+    """
+
+    def __init__(self, n=5):
+        self.n = n
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, label):
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            entry = (time.time() - start, label, profiler)
+            with self.lock:
+                if len(self.slowest) < self.n:
+                    heapq.heappush(self.slowest, entry)
+                elif entry[0] > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def dump(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.lock:
+            entries = sorted(self.slowest, reverse=True)
+        for rank, (duration, label, profiler) in enumerate(entries):
+            path = os.path.join(directory, 'turn_%02u_%ums.prof' % (rank + 1, duration * 1000))
+            profiler.dump_stats(path)
+            logging.info("Slow turn %s (%.0fms) profiled to %s" % (label, duration * 1000, path))
+
+    def report(self, limit=15):
+        output = StringIO()
+        with self.lock:
+            entries = sorted(self.slowest, reverse=True)
+        for duration, label, profiler in entries:
+            output.write("==== %s: %.0fms ====\n" % (label, duration * 1000))
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+@contextmanager
+def optional(manager):
+    if manager is None:
+        yield
+    else:
+        with manager:
+            yield
@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+from Queue import Queue, Empty
+from collections import namedtuple
+
+BattleResult = namedtuple('BattleResult', ['battle_id', 'won', 'turns', 'duration'])
+
+class BattleRecord(object):
+    """
+    Bookkeeping for a single battle run by the orchestrator, independent of
+    the state of the session that plays it.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.status = 'queued'
+        self.worker = None
+        self.result = None
+        self.error = None
+
+class BattleOrchestrator(object):
+    """
+    Runs battles concurrently on a pool of client sessions. Each worker
+    thread owns one session built by client_factory, which must return a
+    client that is logged in and on the home page. When a battle ends, its
+    worker claims one of the battles nobody has started yet, if any are
+    left, so the client can search for it in the same step that closes the
+    current battle. With a SessionPool, workers borrow a session from the
+    pool for each battle instead.
+    """
+
+    def __init__(self, client_factory, concurrency=4, pool=None):
+        self.client_factory = client_factory
+        self.concurrency = concurrency
+        self.pool = pool
+        self.records = []
+        self.unclaimed = 0
+        self.lock = threading.Lock()
+
+    def run(self, n_battles):
+        logging.info("Playing %u battles with %u sessions..." % (n_battles, self.concurrency))
+        self.records = [BattleRecord(i) for i in xrange(n_battles)]
+        self.unclaimed = n_battles
+        queue = Queue()
+        for record in self.records:
+            queue.put(record)
+
+        start = time.time()
+        workers = []
+        work = self.work if self.pool is None else self.work_pooled
+        for i in xrange(min(self.concurrency, n_battles)):
+            worker = threading.Thread(target=work, args=(i, queue))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return summarize(self.records, time.time() - start)
+
+    def claim(self):
+        """
+        Reserves one of the battles still waiting for a session, if any.
+        """
+        with self.lock:
+            if self.unclaimed == 0:
+                return False
+            self.unclaimed -= 1
+            return True
+
+    def work(self, worker_id, queue):
+        client = None
+        claimed = self.claim()
+        while claimed:
+            record = queue.get_nowait()
+            searched = []
+            def search_next():
+                searched.append(self.claim())
+                return searched[0]
+            try:
+                if client is None:
+                    client = self.client_factory(worker_id)
+                with self.lock:
+                    record.status = 'running'
+                    record.worker = worker_id
+                result = client.battle(search_next=search_next)
+                with self.lock:
+                    record.status = 'done'
+                    record.result = result
+            except Exception as e:
+                logging.exception("Battle %u failed on session %u" % (record.index, worker_id))
+                with self.lock:
+                    record.status = 'failed'
+                    record.error = e
+                client = self.discard(client)
+            claimed = searched[0] if searched else self.claim()
+        self.discard(client)
+
+    def work_pooled(self, worker_id, queue):
+        while True:
+            try:
+                record = queue.get_nowait()
+            except Empty:
+                break
+            session = None
+            try:
+                session = self.pool.acquire()
+                with self.lock:
+                    record.status = 'running'
+                    record.worker = worker_id
+                result = session.client.battle()
+                with self.lock:
+                    record.status = 'done'
+                    record.result = result
+            except Exception as e:
+                logging.exception("Battle %u failed on worker %u" % (record.index, worker_id))
+                with self.lock:
+                    record.status = 'failed'
+                    record.error = e
+            if session is not None:
+                self.pool.release(session, failed=record.status == 'failed')
+
+    def discard(self, client):
+        if client is not None:
+            try:
+                client.stop()
+            except Exception:
+                logging.exception("Could not stop session")
+
+def wants_next(search_next):
+    """
+    Resolves a battle's search_next argument, which is either a flag or a
+    function called once the battle is over.
+    """
+    return search_next() if callable(search_next) else search_next
+
+def summarize(records, elapsed):
+    results = [record.result for record in records if record.result is not None]
+    summary = {
+        'battles': len(results),
+        'failed': sum(1 for record in records if record.status == 'failed'),
+        'wins': sum(1 for result in results if result.won),
+        'losses': sum(1 for result in results if result.won is False),
+        'turns': sum(result.turns for result in results),
+        'elapsed': elapsed,
+        'battles_per_hour': len(results) * 3600.0 / elapsed if elapsed > 0 else 0.0,
+    }
+    if results:
+        summary['mean_turns'] = summary['turns'] / float(len(results))
+        summary['mean_duration'] = sum(result.duration for result in results) / len(results)
+    return summary
@@ -0,0 +1,174 @@
+import os
+import time
+import signal
+import logging
+import threading
+from Queue import Queue, Empty
+
+from memory import child_pids
+
+def run_with_timeout(func, timeout):
+    """
+    Calls func in a daemon thread. Returns (finished, result); a call that
+    is still blocked after timeout seconds is abandoned.
+    """
+    outcome = {}
+    def target():
+        try:
+            outcome['result'] = func()
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive() or 'error' in outcome:
+        return False, outcome.get('error')
+    return True, outcome.get('result')
+
+def kill_tree(pid):
+    for child in child_pids(pid):
+        kill_tree(child)
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+class BrowserSession(object):
+
+    def __init__(self, slot, client, warm):
+        self.slot = slot
+        self.client = client
+        self.warm = warm
+        self.battles = 0
+        self.created = time.time()
+
+class SessionPool(object):
+    """
+    Keeps size logged-in ShowdownClient sessions open and lends them out one
+    battle at a time. create_client(slot) returns a client that has not been
+    started; setup(client, slot, warm) logs it in and leaves it on the home
+    page. A slot's cookies and localStorage are saved after its first setup
+    and restored into every browser that later replaces it, in which case
+    warm is True and the teambuilder steps can be skipped.
+
+    A session is replaced after max_battles battles, when its browser uses
+    more than max_rss_mb, when a battle on it fails, or when it does not
+    answer a ping within health_timeout seconds.
+    """
+
+    def __init__(self, create_client, setup, size=4, max_battles=50, max_rss_mb=None,
+                 health_timeout=10.0, retries=3):
+        self.create_client = create_client
+        self.setup = setup
+        self.size = size
+        self.max_battles = max_battles
+        self.max_rss_mb = max_rss_mb
+        self.health_timeout = health_timeout
+        self.retries = retries
+        self.idle = Queue()
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.sessions = {}
+        self.recycled = 0
+
+    def start(self):
+        logging.info("Warming %u browser sessions..." % self.size)
+        threads = [threading.Thread(target=self.replace, args=(slot,)) for slot in xrange(self.size)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        for session in sessions:
+            self.close(session)
+
+    def acquire(self, timeout=600):
+        try:
+            return self.idle.get(timeout=timeout)
+        except Empty:
+            raise RuntimeError("No browser session became available in %ss" % timeout)
+
+    def release(self, session, failed=False):
+        session.battles += 1
+        reason = self.recycle_reason(session, failed)
+        if reason is None:
+            self.idle.put(session)
+            return
+        logging.info("Recycling session %u after %u battles: %s" % (session.slot, session.battles, reason))
+        thread = threading.Thread(target=self.recycle, args=(session, not failed))
+        thread.daemon = True
+        thread.start()
+
+    def recycle_reason(self, session, failed):
+        if self.stopped:
+            return 'pool stopped'
+        if failed:
+            return 'battle failed'
+        if self.max_battles is not None and session.battles >= self.max_battles:
+            return 'battle limit'
+        if self.max_rss_mb is not None:
+            rss_mb = session.client.get_memory_usage() / (1024.0 * 1024.0)
+            if rss_mb > self.max_rss_mb:
+                return 'using %.0fMB' % rss_mb
+        if not self.is_healthy(session):
+            return 'health check failed'
+        return None
+
+    def is_healthy(self, session):
+        finished, result = run_with_timeout(session.client.ping, self.health_timeout)
+        return finished and result
+
+    def recycle(self, session, snapshot):
+        if snapshot:
+            finished, saved = run_with_timeout(session.client.save_session, self.health_timeout)
+            if finished:
+                self.snapshots[session.slot] = saved
+        self.close(session)
+        with self.lock:
+            self.recycled += 1
+        self.replace(session.slot)
+
+    def close(self, session):
+        try:
+            pid = session.client.get_browser_pid()
+        except Exception:
+            logging.exception("Could not find the browser of session %u" % session.slot)
+            pid = None
+        finished, _ = run_with_timeout(session.client.stop, self.health_timeout)
+        if not finished and pid is not None:
+            logging.warning("Session %u did not stop, killing browser %u" % (session.slot, pid))
+            kill_tree(pid)
+
+    def replace(self, slot):
+        for attempt in xrange(self.retries):
+            if self.stopped:
+                return
+            client = None
+            snapshot = self.snapshots.get(slot)
+            try:
+                client = self.create_client(slot)
+                client.start(clear_storage=snapshot is None)
+                if snapshot is not None:
+                    client.restore_session(snapshot)
+                self.setup(client, slot, snapshot is not None)
+                if snapshot is None:
+                    self.snapshots[slot] = client.save_session()
+            except Exception:
+                logging.exception("Could not start session %u (attempt %u)" % (slot, attempt + 1))
+                if client is not None:
+                    self.close(BrowserSession(slot, client, False))
+                continue
+            session = BrowserSession(slot, client, snapshot is not None)
+            with self.lock:
+                self.sessions[slot] = session
+            self.idle.put(session)
+            return
+        logging.error("Giving up on session %u" % slot)
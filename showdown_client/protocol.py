@@ -0,0 +1,570 @@
+import os
+import json
+import time
+import logging
+import urllib
+import urllib2
+from functools import partial
+from collections import OrderedDict, deque
+
+import websocket
+
+from showdown_parser import Gamestate, Pokemon, Move, Switch
+
+from states import require_state, state
+from metrics import Metrics, optional
+from orchestrator import BattleResult, wants_next
+from team import pack_team, to_id
+from deadline import parse_time_left
+from archive import SHOWDOWN_REPLAY_URL, REPLAY_TIMEOUT, upload_replay, upload_in_background
+from steps import CALL, WAIT, DONE, run_steps
+
+SHOWDOWN_WEBSOCKET_URL = os.environ.get('SHOWDOWN_WEBSOCKET_URL', 'ws://sim.smogon.com:8000/showdown/websocket')
+SHOWDOWN_LOGIN_URL = os.environ.get('SHOWDOWN_LOGIN_URL', 'https://play.pokemonshowdown.com/action.php')
+CONDITIONS = set(["tox", "brn", "slp", "par", "psn", "frz"])
+
+def parse_message(message):
+    """
+    Splits a raw websocket frame into its room id and a list of protocol
+    lines, each one a list of the |-separated fields.
+    """
+    lines = message.split('\n')
+    room_id = ''
+    if lines and lines[0].startswith('>'):
+        room_id = lines[0][1:]
+        lines = lines[1:]
+    parsed = []
+    for line in lines:
+        if not line:
+            continue
+        if line.startswith('|'):
+            fields = line[1:].split('|')
+            if fields[0] in ('request', 'updatesearch', 'queryresponse'):
+                fields = [fields[0], '|'.join(fields[1:])]
+            parsed.append(fields)
+        else:
+            parsed.append(['', line])
+    return room_id, parsed
+
+def parse_condition(condition):
+    """
+    Parses a condition string like "245/301 par" or "0 fnt" into
+    (health, faint, status).
+    """
+    parts = condition.split(' ')
+    faint = 'fnt' in parts
+    status = None
+    for part in parts[1:]:
+        if part in CONDITIONS:
+            status = part
+    if faint:
+        return 0.0, True, status
+    if '/' in parts[0]:
+        current, total = parts[0].split('/')
+        return float(current) / float(total), False, status
+    return float(parts[0]) / 100.0, False, status
+
+def get_species(details):
+    return details.split(',')[0]
+
+def get_side(ident):
+    return ident[:2]
+
+def get_nickname(ident):
+    return ident.split(': ', 1)[1]
+
+class BattleRoom(object):
+    """
+    Battle state reconstructed from the protocol messages of a single
+    battle room.
+    """
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.side = None
+        self.request = None
+        self.request_pending = False
+        self.ready = False
+        self.ready_time = None
+        self.turn = 0
+        self.ended = False
+        self.winner = None
+        self.time_left = None
+        self.time_left_at = None
+        self.log = []
+        self.pokemon = {'p1': OrderedDict(), 'p2': OrderedDict()}
+        self.nicknames = {'p1': {}, 'p2': {}}
+        self.active = {'p1': None, 'p2': None}
+
+    def get_opponent_side(self):
+        return 'p2' if self.side == 'p1' else 'p1'
+
+    def get_pokemon(self, side, species):
+        if species not in self.pokemon[side]:
+            self.pokemon[side][species] = {'health': 1.0, 'faint': False, 'status': None}
+        return self.pokemon[side][species]
+
+    def set_species(self, side, nickname, species):
+        """
+        Records that nickname on side is species. If it was known under
+        another species, e.g. before mega evolving, its entry is renamed in
+        place rather than left behind as an extra team member.
+        """
+        old = self.nicknames[side].get(nickname)
+        self.nicknames[side][nickname] = species
+        if old is not None and old != species and old in self.pokemon[side]:
+            if species in self.pokemon[side]:
+                del self.pokemon[side][old]
+            else:
+                self.pokemon[side] = OrderedDict((species if key == old else key, info)
+                                                 for key, info in self.pokemon[side].items())
+            if self.active[side] == old:
+                self.active[side] = species
+        return self.get_pokemon(side, species)
+
+    def get_ident_pokemon(self, ident):
+        side = get_side(ident)
+        species = self.nicknames[side].get(get_nickname(ident))
+        if species is None:
+            return None
+        return self.get_pokemon(side, species)
+
+    def handle(self, lines):
+        requested = False
+        for fields in lines:
+            kind, args = fields[0], fields[1:]
+            if kind == '':
+                if args:
+                    self.log.append(args[0])
+                continue
+            self.log.append('|'.join(fields))
+            if kind == 'request':
+                if args[0]:
+                    self.set_request(json.loads(args[0]))
+                    requested = True
+            elif kind == 'poke':
+                self.get_pokemon(args[0], get_species(args[1]))
+            elif kind in ('switch', 'drag', 'replace'):
+                side = get_side(args[0])
+                species = get_species(args[1])
+                poke = self.set_species(side, get_nickname(args[0]), species)
+                self.active[side] = species
+                if len(args) > 2:
+                    poke['health'], poke['faint'], poke['status'] = parse_condition(args[2])
+            elif kind in ('detailschange', '-formechange'):
+                poke = self.set_species(get_side(args[0]), get_nickname(args[0]), get_species(args[1]))
+                if len(args) > 2 and args[2]:
+                    poke['health'], poke['faint'], poke['status'] = parse_condition(args[2])
+            elif kind in ('-damage', '-heal', '-sethp'):
+                poke = self.get_ident_pokemon(args[0])
+                if poke is not None:
+                    poke['health'], poke['faint'], poke['status'] = parse_condition(args[1])
+            elif kind == 'faint':
+                poke = self.get_ident_pokemon(args[0])
+                if poke is not None:
+                    poke['health'], poke['faint'] = 0.0, True
+            elif kind == '-status':
+                poke = self.get_ident_pokemon(args[0])
+                if poke is not None:
+                    poke['status'] = args[1]
+            elif kind == '-curestatus':
+                poke = self.get_ident_pokemon(args[0])
+                if poke is not None:
+                    poke['status'] = None
+            elif kind == 'turn':
+                self.turn = int(args[0])
+            elif kind == 'inactive':
+                seconds = parse_time_left(args[0] if args else '')
+                if seconds is not None:
+                    self.time_left, self.time_left_at = seconds, time.time()
+            elif kind == 'win':
+                self.ended = True
+                self.winner = args[0]
+            elif kind == 'tie':
+                self.ended = True
+        if requested:
+            self.ready = False
+        elif self.request_pending and not self.ready:
+            self.ready = True
+            self.ready_time = time.time()
+
+    def set_request(self, request):
+        self.request = request
+        self.side = request['side']['id']
+        self.request_pending = not request.get('wait', False)
+        for poke in request['side']['pokemon']:
+            species = get_species(poke['details'])
+            info = self.set_species(self.side, get_nickname(poke['ident']), species)
+            info['health'], info['faint'], info['status'] = parse_condition(poke['condition'])
+            if poke.get('active'):
+                self.active[self.side] = species
+
+    def get_time_left(self):
+        if self.time_left is None:
+            return None
+        return self.time_left - (time.time() - self.time_left_at)
+
+    def needs_action(self):
+        return self.request_pending and self.ready and not self.ended
+
+    def is_team_preview(self):
+        return bool(self.request and self.request.get('teamPreview'))
+
+    def get_team(self):
+        return self.request['side']['pokemon']
+
+class Receive(object):
+    """
+    A wait step of ProtocolClient.battle_steps: reads and handles one
+    message, waiting at most timeout seconds if timeout is not None.
+    """
+
+    def __init__(self, client, timeout=None):
+        self.client = client
+        self.timeout = timeout
+
+    def __call__(self):
+        return self.client.receive(self.timeout)
+
+class ProtocolClient(object):
+    """
+    Plays on Showdown by speaking the sim protocol over a websocket instead
+    of driving a browser. Mirrors the ShowdownClient API and state machine.
+    Messages are read from inbox first, which AsyncProtocolClient fills
+    from the websocket without blocking.
+    """
+
+    def __init__(self, agent, url=SHOWDOWN_WEBSOCKET_URL, login_url=SHOWDOWN_LOGIN_URL,
+                 username=None, password=None, connect=websocket.create_connection,
+                 metrics=None, profiler=None, archiver=None, recorder=None, scheduler=None,
+                 replay_url=SHOWDOWN_REPLAY_URL):
+        self.agent = agent
+        self.server_url = url
+        self.login_url = login_url
+        self.replay_url = replay_url
+        self.archiver = archiver
+        self.recorder = recorder
+        self.scheduler = scheduler
+        self.state = None
+        self.username = username
+        self.password = password
+        self.connect = connect
+        self.connection = None
+        self.inbox = deque()
+
+        self.challstr = None
+        self.named = False
+        self.battle_format = 'ou'
+        self.team_format = 'ou'
+        self.room = None
+        self.searching = False
+        self.replay_saved = False
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler
+        self.reaction_latency = self.metrics.histogram('reaction_latency_ms')
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+
+    def send(self, room_id, message):
+        self.metrics.count_call()
+        self.connection.send('%s|%s' % (room_id, message))
+
+    def receive(self, timeout=None):
+        """
+        Reads and handles one message and returns (room_id, lines), or None
+        if nothing came within timeout seconds.
+        """
+        if self.inbox:
+            message = self.inbox.popleft()
+        elif timeout is None:
+            message = self.connection.recv()
+        else:
+            self.connection.settimeout(max(0.01, timeout))
+            try:
+                message = self.connection.recv()
+            except websocket.WebSocketTimeoutException:
+                return None
+            finally:
+                self.connection.settimeout(None)
+        return self.handle_message(message)
+
+    def handle_message(self, message):
+        room_id, lines = parse_message(message)
+        if room_id.startswith('battle-'):
+            if self.room is None or self.room.room_id != room_id:
+                if not any(fields[:2] == ['init', 'battle'] for fields in lines):
+                    return room_id, lines
+                logging.info("Joined battle room: %s" % room_id)
+                self.room = BattleRoom(room_id)
+            self.room.handle(lines)
+        else:
+            self.handle_global(lines)
+        return room_id, lines
+
+    def handle_global(self, lines):
+        for fields in lines:
+            kind, args = fields[0], fields[1:]
+            if kind == 'challstr':
+                self.challstr = '|'.join(args)
+            elif kind == 'updateuser':
+                self.named = args[1] == '1'
+                if self.named:
+                    self.username = args[0].strip()
+            elif kind in ('popup', 'nametaken'):
+                logging.info("Server: %s" % '|'.join(args))
+            elif kind == 'queryresponse' and args[0].startswith('savereplay|'):
+                self.replay_saved = True
+                self.archive_replay(json.loads(args[0].split('|', 1)[1]))
+
+    def archive_replay(self, replay):
+        if self.archiver is None:
+            upload_in_background(self.replay_url, replay)
+            return
+        self.archiver.submit(replay['id'], upload=partial(upload_replay, self.replay_url, replay))
+
+    def wait_for(self, predicate):
+        while not predicate():
+            self.receive()
+
+    def mute(self):
+        pass
+
+    @require_state(['battle_main', 'start_battle'])
+    def chat(self, text):
+        logging.info("Sending chat: %s" % text)
+        self.send(self.room.room_id, text)
+
+    @state(None, 'homepage')
+    def start(self):
+        logging.info("Connecting to %s..." % self.server_url)
+        self.connection = self.connect(self.server_url)
+
+    @state(None, 'stopped')
+    def stop(self):
+        logging.info("Closing connection...")
+        self.connection.close()
+
+    @state(None, 'homepage')
+    def home(self):
+        pass
+
+    def get_assertion(self, username, password):
+        if password:
+            data = urllib.urlencode({
+                'act': 'login',
+                'name': username,
+                'pass': password,
+                'challstr': self.challstr,
+            })
+            response = urllib2.urlopen(self.login_url, data).read()
+            return json.loads(response[1:])['assertion']
+        data = urllib.urlencode({
+            'act': 'getassertion',
+            'userid': to_id(username),
+            'challstr': self.challstr,
+        })
+        return urllib2.urlopen('%s?%s' % (self.login_url, data)).read()
+
+    @state(['homepage'], 'homepage')
+    def choose_name(self, username=None, password=None):
+        username = username or self.username
+        password = password or self.password
+        logging.info("Logging in as %s..." % username)
+        self.wait_for(lambda: self.challstr is not None)
+        assertion = self.get_assertion(username, password)
+        self.send('', '/trn %s,0,%s' % (username, assertion))
+        self.wait_for(lambda: self.named)
+        self.username = username
+
+    @state(['homepage'], 'teambuilder')
+    def teambuilder(self):
+        pass
+
+    @state(['teambuilder'], 'teambuilder')
+    def create_team(self, text, name=None):
+        logging.info("Creating team...")
+        self.send('', '/utm %s' % pack_team(text))
+
+    @state(['homepage'], 'homepage')
+    def select_battle_format(self, tier='ou'):
+        logging.info("Selecting battle tier...")
+        self.battle_format = tier
+
+    @state(['teambuilder'], 'teambuilder')
+    def select_team_format(self, tier='ou'):
+        logging.info("Selecting team tier...")
+        self.team_format = tier
+
+    @require_state(['start_battle', 'battle_main'])
+    def get_legal_actions(self):
+        if self.room.is_team_preview():
+            return [Switch(get_species(poke['details'])) for poke in self.room.get_team()]
+        request = self.room.request
+        actions = []
+        trapped = False
+        if not any(request.get('forceSwitch', [])) and 'active' in request:
+            active = request['active'][0]
+            for move in active['moves']:
+                if not move.get('disabled'):
+                    actions.append(Move(move['move']))
+            trapped = active.get('trapped', False)
+        if not trapped:
+            for poke in self.room.get_team():
+                if not poke.get('active') and not parse_condition(poke['condition'])[1]:
+                    actions.append(Switch(get_species(poke['details'])))
+        return actions
+
+    def get_choice(self, action):
+        request = self.room.request
+        if action.is_switch():
+            for i, poke in enumerate(self.room.get_team()):
+                if get_species(poke['details']) == action.get_name():
+                    if self.room.is_team_preview():
+                        return 'team %u' % (i + 1)
+                    return 'switch %u' % (i + 1)
+        if action.is_move() and 'active' in request:
+            active = request['active'][0]
+            for i, move in enumerate(active['moves']):
+                if move['move'] == action.get_name():
+                    if active.get('canMegaEvo'):
+                        return 'move %u mega' % (i + 1)
+                    return 'move %u' % (i + 1)
+
+    @require_state(['start_battle', 'battle_main'])
+    def perform_action(self, action):
+        choice = self.get_choice(action)
+        if choice is None:
+            return False
+        self.send(self.room.room_id, '/choose %s|%u' % (choice, self.room.request['rqid']))
+        self.room.request_pending = False
+        return True
+
+    @state(['homepage'], 'homepage')
+    def play(self, n_iters):
+        logging.info("Playing %u battles..." % n_iters)
+        return [self.battle(search_next=i + 1 < n_iters) for i in xrange(n_iters)]
+
+    @state(['start_battle'], 'battle_main')
+    def select_initial(self):
+        self.make_action(initial=True)
+
+    @require_state(['start_battle', 'battle_main'])
+    def get_gamestate(self):
+        teams = ([], [])
+        primary = [None, None]
+        for i, side in enumerate([self.room.side, self.room.get_opponent_side()]):
+            for species, info in self.room.pokemon[side].items():
+                poke = Pokemon(species, faint=info['faint'], health=info['health'])
+                poke.status = info['status']
+                teams[i].append(poke)
+            if self.room.active[side] in self.room.pokemon[side]:
+                primary[i] = self.room.active[side]
+        gamestate = Gamestate(teams=teams)
+        for i, p in enumerate(primary):
+            if p is not None:
+                gamestate.set_primary(i, p)
+        gamestate.battle_id = self.room.room_id
+        gamestate.turn = self.room.turn
+        return gamestate
+
+    def choose_action(self, gamestate, actions, initial):
+        if self.scheduler is None:
+            return self.agent.get_action(gamestate, actions, initial=initial)
+        return self.scheduler.get_action(self.agent, gamestate, actions, initial=initial,
+                                         time_left=self.room.get_time_left())
+
+    def make_action(self, initial=False):
+        profile = self.profiler.profile(self.room.room_id) if self.profiler is not None else None
+        with optional(profile), self.metrics.span('turn'):
+            with self.metrics.span('get_gamestate'):
+                gamestate = self.get_gamestate()
+            with self.metrics.span('get_legal_actions'):
+                actions = self.get_legal_actions()
+            with self.metrics.span('get_action'):
+                selected_action = self.choose_action(gamestate, actions, initial)
+            with self.metrics.span('perform_action'):
+                for action in actions:
+                    if action == selected_action:
+                        self.perform_action(action)
+        if self.recorder is not None:
+            self.recorder.record(self.room.room_id, gamestate, actions, selected_action,
+                                 encoded=getattr(gamestate, 'encoded', None))
+
+    @state(['homepage'], 'homepage')
+    def battle(self, search_next=False):
+        """
+        Plays one battle by running battle_steps' calls in this thread.
+        """
+        return run_steps(self.battle_steps(search_next))
+
+    def battle_steps(self, search_next=False):
+        """
+        The body of battle as a step generator, like
+        ShowdownClient.battle_steps: agent decisions are yielded as
+        (CALL, function) and every read from the websocket as
+        (WAIT, Receive), so AsyncProtocolClient can read without blocking.
+        Sends are short and made in place.
+
+        With search_next the next /search goes out right after /leave. The
+        replay is uploaded in the background, by the archiver if there is
+        one, once the server answers /savereplay; if no search is queued
+        that answer is waited for here, at most REPLAY_TIMEOUT seconds, so
+        the last battle's replay is not lost.
+        """
+        self.room = None
+        if not self.searching:
+            logging.info("Searching for battle...")
+            self.send('', '/search %s' % self.battle_format)
+        self.searching = False
+        with self.metrics.step_span('wait_battle'):
+            while self.room is None:
+                yield WAIT, Receive(self)
+        start = time.time()
+        self.set_state('start_battle')
+        self.chat('gl hf')
+        self.send(self.room.room_id, '/timer on')
+        while not self.room.ended:
+            if self.room.needs_action():
+                if self.room.is_team_preview():
+                    yield CALL, self.select_initial
+                else:
+                    if self.get_state() == 'start_battle':
+                        self.set_state('battle_main')
+                    yield CALL, self.make_action
+                self.reaction_latency.record((time.time() - self.room.ready_time) * 1000.0)
+                self.room.ready = False
+            else:
+                with self.metrics.step_span('wait_event'):
+                    yield WAIT, Receive(self)
+        logging.info("Reaction latency (ms): %s" % self.reaction_latency)
+        result = BattleResult(self.room.room_id,
+                              None if self.room.winner is None else self.room.winner == self.username,
+                              self.room.turn,
+                              time.time() - start)
+        self.chat('gg')
+        logging.info("Battle complete! Saving replay...")
+        self.replay_saved = False
+        self.send(self.room.room_id, '/savereplay')
+        self.send('', '/leave %s' % self.room.room_id)
+        if wants_next(search_next):
+            self.send('', '/search %s' % self.battle_format)
+            self.searching = True
+        else:
+            deadline = time.time() + REPLAY_TIMEOUT
+            while not self.replay_saved and time.time() < deadline:
+                yield WAIT, Receive(self, deadline - time.time())
+            if not self.replay_saved:
+                logging.warning("No replay from the server after %us" % REPLAY_TIMEOUT)
+        yield CALL, partial(self.finish_battle, result)
+        self.home()
+        yield DONE, result
+
+    def finish_battle(self, result):
+        if self.recorder is not None:
+            self.recorder.finish(self.room.room_id, result.won)
+        if self.archiver is not None:
+            self.archiver.submit(self.room.room_id, log='\n'.join(self.room.log), result=result)
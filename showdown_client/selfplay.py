@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import logging
+import multiprocessing
+from collections import namedtuple
+
+from showdown_parser import Gamestate, Pokemon, Move, Switch
+
+from sim import Battle
+
+GameResult = namedtuple('GameResult', ['seed', 'winner', 'turns', 'duration', 'worker'])
+
+def to_gamestate(battle, i):
+    """
+    The Gamestate side i of a sim battle sees, with its own team first.
+    """
+    sides = [battle.sides[i], battle.sides[1 - i]]
+    teams = ([], [])
+    for j, side in enumerate(sides):
+        for poke in side.pokemon:
+            pokemon = Pokemon(poke.species, faint=poke.faint, health=poke.health)
+            pokemon.status = None
+            teams[j].append(pokemon)
+    gamestate = Gamestate(teams=teams)
+    if battle.phase != 'preview':
+        for j, side in enumerate(sides):
+            gamestate.set_primary(j, side.active().species)
+    return gamestate
+
+def to_choice(battle, i, action):
+    """
+    Returns the sim choice for action on side i, or None if the sim has no
+    such choice.
+    """
+    side = battle.sides[i]
+    if action.is_move():
+        moves = side.active().moves
+        if action.get_name() in moves:
+            return 'move %u' % (moves.index(action.get_name()) + 1)
+        return None
+    kind = 'team' if battle.phase == 'preview' else 'switch'
+    for j, poke in enumerate(side.pokemon):
+        if poke.species == action.get_name() and (kind == 'team' or j > 0):
+            return '%s %u' % (kind, j + 1)
+    return None
+
+def to_action(battle, i, choice):
+    kind, index = choice.split()[:2]
+    side = battle.sides[i]
+    if kind == 'move':
+        return Move(side.active().moves[int(index) - 1])
+    return Switch(side.pokemon[int(index) - 1].species)
+
+def get_legal_actions(battle, i):
+    return [to_action(battle, i, choice) for choice in battle.legal_choices(i)]
+
+def play_game(agents, teams, seed, recorder=None, max_turns=300):
+    """
+    Plays one sim battle between agents[0] (p1) and agents[1] (p2) and
+    returns (winner, turns); winner is 0, 1 or None. An action the sim
+    cannot play is replaced by the first legal choice.
+    """
+    battle = Battle(teams, seed=seed, max_turns=max_turns)
+    battle.start()
+    battle_ids = ['selfplay-%u-p1' % seed, 'selfplay-%u-p2' % seed]
+    while not battle.ended:
+        for i in xrange(2):
+            if not battle.legal_choices(i):
+                continue
+            gamestate = to_gamestate(battle, i)
+            gamestate.battle_id = battle_ids[i]
+            gamestate.turn = battle.turn
+            actions = get_legal_actions(battle, i)
+            action = agents[i].get_action(gamestate, actions, initial=battle.phase == 'preview')
+            choice = to_choice(battle, i, action) if action is not None else None
+            if choice not in battle.legal_choices(i):
+                choice = battle.legal_choices(i)[0]
+            if recorder is not None:
+                recorder.record(battle_ids[i], gamestate, actions, to_action(battle, i, choice),
+                                encoded=getattr(gamestate, 'encoded', None))
+            battle.choose(i, choice)
+        battle.step()
+    if recorder is not None:
+        for i in xrange(2):
+            recorder.finish(battle_ids[i], None if battle.winner is None else battle.winner == i)
+    return battle.winner, battle.turn
+
+worker = {}
+
+def init_worker(make_agents, make_recorder, teams, max_turns, quiet):
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    worker['agents'] = make_agents()
+    worker['recorder'] = make_recorder() if make_recorder is not None else None
+    worker['teams'] = teams
+    worker['max_turns'] = max_turns
+
+def run_game(seed):
+    start = time.time()
+    for i, agent in enumerate(worker['agents']):
+        agent.reseed((seed, i))
+    winner, turns = play_game(worker['agents'], worker['teams'], seed, recorder=worker['recorder'],
+                              max_turns=worker['max_turns'])
+    return GameResult(seed, winner, turns, time.time() - start, os.getpid())
+
+class SelfPlay(object):
+    """
+    Plays games between two agents in the local sim on a pool of
+    processes. make_agents() is called once in each worker and returns the
+    (p1, p2) agents; make_recorder(), if given, returns that worker's
+    TrajectoryRecorder, which must write to a directory of its own. Games
+    share nothing, so throughput grows with the number of processes.
+    """
+
+    def __init__(self, make_agents, teams, processes=None, make_recorder=None, max_turns=300, quiet=True):
+        self.make_agents = make_agents
+        self.make_recorder = make_recorder
+        self.teams = teams
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_turns = max_turns
+        self.quiet = quiet
+
+    def run(self, n_games, seed=0, chunksize=4):
+        logging.info("Playing %u self-play games on %u processes..." % (n_games, self.processes))
+        pool = multiprocessing.Pool(self.processes, initializer=init_worker,
+                                    initargs=(self.make_agents, self.make_recorder, self.teams, self.max_turns,
+                                              self.quiet))
+        try:
+            results = list(pool.imap_unordered(run_game, xrange(seed, seed + n_games), chunksize))
+        finally:
+            pool.close()
+            pool.join()
+        return sorted(results, key=lambda result: result.seed)
+
+def summarize(results, elapsed):
+    games = len(results)
+    return {
+        'games': games,
+        'p1_wins': sum(1 for result in results if result.winner == 0),
+        'p2_wins': sum(1 for result in results if result.winner == 1),
+        'ties': sum(1 for result in results if result.winner is None),
+        'turns': sum(result.turns for result in results),
+        'elapsed': elapsed,
+        'games_per_sec': games / elapsed if elapsed > 0 else 0.0,
+    }
@@ -0,0 +1,204 @@
+import json
+import random
+
+from team import to_id
+
+class SimPokemon(object):
+
+    def __init__(self, nickname, species, moves):
+        self.nickname = nickname
+        self.species = species
+        self.moves = moves or ['Struggle']
+        self.health = 1.0
+        self.faint = False
+
+    def condition(self):
+        if self.faint:
+            return '0 fnt'
+        return '%u/100' % max(1, int(round(self.health * 100)))
+
+class SimSide(object):
+
+    def __init__(self, side_id, name, team):
+        self.id = side_id
+        self.name = name
+        self.pokemon = [SimPokemon(poke['nickname'], poke['species'], poke['moves']) for poke in team]
+        self.choice = None
+
+    def active(self):
+        return self.pokemon[0]
+
+    def ident(self, poke):
+        return '%sa: %s' % (self.id, poke.nickname)
+
+    def bench(self):
+        return [i for i, poke in enumerate(self.pokemon) if i > 0 and not poke.faint]
+
+    def defeated(self):
+        return all(poke.faint for poke in self.pokemon)
+
+    def switch(self, index):
+        self.pokemon[0], self.pokemon[index] = self.pokemon[index], self.pokemon[0]
+        poke = self.active()
+        return '|switch|%s|%s|%s' % (self.ident(poke), poke.species, poke.condition())
+
+class Battle(object):
+    """
+    A stand-in for the Showdown simulator: two teams, every move deals a
+    random share of the target's HP, speed ties are random. It speaks the
+    same requests, choices and log lines as the real server, which is
+    enough to drive the clients and agents without a network.
+    """
+
+    def __init__(self, teams, names=('p1', 'p2'), seed=None, damage=(0.15, 0.45), max_turns=300):
+        self.rng = random.Random(seed)
+        self.sides = [SimSide('p1', names[0], teams[0]), SimSide('p2', names[1], teams[1])]
+        self.damage = damage
+        self.max_turns = max_turns
+        self.phase = 'preview'
+        self.pending = [True, True]
+        self.turn = 0
+        self.rqid = 0
+        self.ended = False
+        self.winner = None
+
+    def start(self):
+        lines = ['|init|battle']
+        for side in self.sides:
+            lines.append('|player|%s|%s|1' % (side.id, side.name))
+        for side in self.sides:
+            lines.append('|teamsize|%s|%u' % (side.id, len(side.pokemon)))
+        for side in self.sides:
+            for poke in side.pokemon:
+                lines.append('|poke|%s|%s|' % (side.id, poke.species))
+        lines.append('|teampreview')
+        return lines
+
+    def request(self, i):
+        side = self.sides[i]
+        self.rqid += 1
+        request = {
+            'rqid': self.rqid,
+            'side': {
+                'name': side.name,
+                'id': side.id,
+                'pokemon': [{
+                    'ident': '%s: %s' % (side.id, poke.nickname),
+                    'details': poke.species,
+                    'condition': poke.condition(),
+                    'active': j == 0 and self.phase != 'preview',
+                    'moves': [to_id(move) for move in poke.moves],
+                } for j, poke in enumerate(side.pokemon)],
+            },
+        }
+        if self.phase == 'preview':
+            request['teamPreview'] = True
+        elif not self.pending[i]:
+            request['wait'] = True
+        elif self.phase == 'switch':
+            request['forceSwitch'] = [True]
+        else:
+            request['active'] = [{
+                'moves': [{
+                    'move': move,
+                    'id': to_id(move),
+                    'pp': 16,
+                    'maxpp': 16,
+                    'target': 'normal',
+                    'disabled': False,
+                } for move in side.active().moves],
+            }]
+        return request
+
+    def request_line(self, i):
+        return '|request|%s' % json.dumps(self.request(i))
+
+    def legal_choices(self, i):
+        side = self.sides[i]
+        if self.ended or not self.pending[i]:
+            return []
+        if self.phase == 'preview':
+            return ['team %u' % (j + 1) for j in xrange(len(side.pokemon))]
+        switches = ['switch %u' % (j + 1) for j in side.bench()]
+        if self.phase == 'switch':
+            return switches
+        return ['move %u' % (j + 1) for j in xrange(len(side.active().moves))] + switches
+
+    def choose(self, i, choice):
+        choice = ' '.join(choice.split()[:2])
+        if choice not in self.legal_choices(i):
+            raise ValueError("Invalid choice for %s: %s" % (self.sides[i].id, choice))
+        self.sides[i].choice = choice
+
+    def ready(self):
+        return all(side.choice is not None or not pending for side, pending in zip(self.sides, self.pending))
+
+    def step(self):
+        lines = ['|']
+        if self.phase == 'preview':
+            for side in self.sides:
+                lead = int(side.choice.split()[1]) - 1
+                side.pokemon.insert(0, side.pokemon.pop(lead))
+            for side in self.sides:
+                poke = side.active()
+                lines.append('|switch|%s|%s|%s' % (side.ident(poke), poke.species, poke.condition()))
+            self.next_turn(lines)
+        elif self.phase == 'switch':
+            for side in self.sides:
+                if side.choice is not None:
+                    lines.append(side.switch(int(side.choice.split()[1]) - 1))
+            self.next_turn(lines)
+        else:
+            self.resolve_moves(lines)
+        for side in self.sides:
+            side.choice = None
+        return lines
+
+    def resolve_moves(self, lines):
+        moves = []
+        for i, side in enumerate(self.sides):
+            kind, index = side.choice.split()
+            if kind == 'switch':
+                lines.append(side.switch(int(index) - 1))
+            else:
+                moves.append((i, int(index) - 1))
+        self.rng.shuffle(moves)
+        for i, move in moves:
+            attacker, defending = self.sides[i], self.sides[1 - i]
+            poke, target = attacker.active(), defending.active()
+            if poke.faint or target.faint:
+                continue
+            lines.append('|move|%s|%s|%s' % (attacker.ident(poke), poke.moves[move], defending.ident(target)))
+            target.health = max(0.0, target.health - self.rng.uniform(*self.damage))
+            if target.health <= 0.005:
+                target.health, target.faint = 0.0, True
+            lines.append('|-damage|%s|%s' % (defending.ident(target), target.condition()))
+            if target.faint:
+                lines.append('|faint|%s' % defending.ident(target))
+        for side in self.sides:
+            if side.defeated():
+                return self.finish(lines)
+        self.pending = [side.active().faint for side in self.sides]
+        if any(self.pending):
+            self.phase = 'switch'
+        else:
+            lines.append('|upkeep')
+            self.next_turn(lines)
+
+    def next_turn(self, lines):
+        self.turn += 1
+        if self.turn > self.max_turns:
+            return self.finish(lines)
+        self.phase = 'move'
+        self.pending = [True, True]
+        lines.append('|turn|%u' % self.turn)
+
+    def finish(self, lines):
+        self.ended = True
+        self.pending = [False, False]
+        alive = [not side.defeated() for side in self.sides]
+        if alive[0] != alive[1]:
+            self.winner = 0 if alive[0] else 1
+            lines.append('|win|%s' % self.sides[self.winner].name)
+        else:
+            lines.append('|tie')
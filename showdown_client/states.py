@@ -0,0 +1,36 @@
+class StateException(Exception):
+
+    def __init__(self, method, in_states, current_state):
+        message = "Client tried calling <{method}> method while in [{current_state}]. Appropriate states: {states}".format(
+            method=method,
+            current_state=current_state,
+            states=str(list(in_states))
+        )
+        super(StateException, self).__init__(message)
+
+def require_state(in_states):
+    if in_states is not None:
+        in_states = set(in_states)
+    def inner(func):
+        def f(self, *args, **kwargs):
+            if in_states is not None:
+                if self.get_state() not in in_states:
+                    raise StateException(func.__name__, in_states, self.get_state())
+            result = func(self, *args, **kwargs)
+            return result
+        return f
+    return inner
+
+def state(in_states, out_state):
+    if in_states is not None:
+        in_states = set(in_states)
+    def inner(func):
+        def f(self, *args, **kwargs):
+            if in_states is not None:
+                if self.get_state() not in in_states:
+                    raise StateException(func.__name__, in_states, self.get_state())
+            result = func(self, *args, **kwargs)
+            self.set_state(out_state)
+            return result
+        return f
+    return inner
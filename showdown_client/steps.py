@@ -0,0 +1,17 @@
+CALL, WAIT, DONE = 'call', 'wait', 'done'
+
+def run_steps(steps):
+    """
+    Runs the calls yielded by a step generator such as
+    ShowdownClient.battle_steps in this thread and returns its result.
+    Every other item is (CALL, function) or (WAIT, function), a call that
+    may block for long; the function's result is sent back. The last item
+    is (DONE, result).
+    """
+    result = None
+    while True:
+        kind, value = steps.send(result)
+        if kind == DONE:
+            steps.close()
+            return value
+        result = value()
@@ -0,0 +1,100 @@
+import re
+
+STATS = ['HP', 'Atk', 'Def', 'SpA', 'SpD', 'Spe']
+
+def to_id(text):
+    return re.sub(r'[^a-z0-9]+', '', text.lower())
+
+def parse_spread(text, default):
+    values = dict((stat, default) for stat in STATS)
+    for part in text.split('/'):
+        amount, stat = part.strip().split(' ', 1)
+        values[stat.strip()] = int(amount)
+    return [values[stat] for stat in STATS]
+
+def parse_team(text):
+    """
+    Parses a team in the Showdown teambuilder export format into a list
+    of dicts, one per Pokemon.
+    """
+    team = []
+    for block in re.split(r'\n\s*\n', text.strip()):
+        lines = [line.strip() for line in block.strip().split('\n') if line.strip()]
+        if not lines:
+            continue
+        header = lines[0]
+        item = ''
+        if ' @ ' in header:
+            header, item = header.rsplit(' @ ', 1)
+        gender = ''
+        match = re.match(r'(?P<name>.+) \((?P<gender>[MF])\)$', header)
+        if match:
+            header, gender = match.group('name'), match.group('gender')
+        match = re.match(r'(?P<nickname>.+) \((?P<species>.+)\)$', header)
+        if match:
+            nickname, species = match.group('nickname'), match.group('species')
+        else:
+            nickname, species = header, header
+        poke = {
+            'nickname': nickname,
+            'species': species,
+            'item': item.strip(),
+            'ability': '',
+            'moves': [],
+            'nature': '',
+            'evs': [0] * 6,
+            'gender': gender,
+            'ivs': [31] * 6,
+            'shiny': False,
+            'level': 100,
+            'happiness': 255,
+        }
+        for line in lines[1:]:
+            if line.startswith('- '):
+                poke['moves'].append(line[2:].strip())
+            elif line.startswith('Ability:'):
+                poke['ability'] = line[len('Ability:'):].strip()
+            elif line.startswith('EVs:'):
+                poke['evs'] = parse_spread(line[len('EVs:'):], 0)
+            elif line.startswith('IVs:'):
+                poke['ivs'] = parse_spread(line[len('IVs:'):], 31)
+            elif line.startswith('Level:'):
+                poke['level'] = int(line[len('Level:'):])
+            elif line.startswith('Happiness:'):
+                poke['happiness'] = int(line[len('Happiness:'):])
+            elif line.startswith('Shiny:'):
+                poke['shiny'] = line[len('Shiny:'):].strip() == 'Yes'
+            elif line.endswith(' Nature'):
+                poke['nature'] = line[:-len(' Nature')].strip()
+        team.append(poke)
+    return team
+
+def pack_spread(values, default):
+    spread = ['' if value == default else str(value) for value in values]
+    if not any(spread):
+        return ''
+    return ','.join(spread)
+
+def pack_team(text):
+    """
+    Converts a teambuilder export into the packed format expected by the
+    /utm command.
+    """
+    packed = []
+    for poke in parse_team(text):
+        species = '' if poke['species'] == poke['nickname'] else poke['species']
+        packed.append('|'.join([
+            poke['nickname'],
+            species,
+            to_id(poke['item']),
+            to_id(poke['ability']),
+            ','.join(to_id(move) for move in poke['moves']),
+            poke['nature'],
+            pack_spread(poke['evs'], 0),
+            poke['gender'],
+            pack_spread(poke['ivs'], 31),
+            'S' if poke['shiny'] else '',
+            '' if poke['level'] == 100 else str(poke['level']),
+            '' if poke['happiness'] == 255 else str(poke['happiness']),
+        ]))
+    return ']'.join(packed)
@@ -0,0 +1,229 @@
+import os
+import json
+import glob
+import errno
+import logging
+import threading
+
+import numpy as np
+
+from agent import action_key
+from cache import LRUCache
+
+TRAJECTORY_FORMAT = 1
+
+META = 'meta.json'
+INDEX = 'battles.jsonl'
+STATES = 'states.bin'
+MASKS = 'masks.bin'
+ACTIONS = 'actions.bin'
+
+ACTION_DTYPE = np.int16
+OUTCOMES = {True: 1, False: -1, None: 0}
+
+class TrajectoryBuffer(object):
+    """
+    Fixed-size ring buffer for the turns of one battle. When a battle runs
+    longer than capacity turns only the last capacity turns are kept.
+    """
+
+    def __init__(self, state_dim, mask_bytes, capacity=512, dtype=np.float16):
+        self.states = np.zeros((capacity, state_dim), dtype=dtype)
+        self.masks = np.zeros((capacity, mask_bytes), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=ACTION_DTYPE)
+        self.capacity = capacity
+        self.count = 0
+
+    def append(self, state, mask, action):
+        i = self.count % self.capacity
+        self.states[i] = state
+        self.masks[i] = mask
+        self.actions[i] = action
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def order(self):
+        if self.count <= self.capacity:
+            return np.arange(self.count)
+        return np.roll(np.arange(self.capacity), -(self.count % self.capacity))
+
+class TrajectoryRecorder(object):
+    """
+    Records the encoded gamestate, legal action mask and chosen action of
+    every turn, and writes each battle to directory/shard-NNNNN once its
+    outcome is known. Shards hold three append-only raw files (states as
+    dtype, masks bit-packed, actions as int16), a meta.json describing them
+    and a battles.jsonl index, which is written after the data so readers
+    only ever see whole battles. A shard is closed after shard_turns turns.
+
+    At most max_battles battles are buffered at once; the least recently
+    played one is dropped when a new battle would exceed that.
+    """
+
+    def __init__(self, directory, converter, encoder=None, capacity=512, max_battles=64,
+                 shard_turns=1 << 20, dtype=np.float16):
+        self.directory = directory
+        self.converter = converter
+        self.encoder = encoder
+        self.capacity = capacity
+        self.shard_turns = shard_turns
+        self.dtype = np.dtype(dtype)
+
+        self.actions = converter.get_actions()
+        self.action_index = dict((action_key(action), i) for i, action in enumerate(self.actions))
+        self.state_dim = converter.get_input_dimension()
+        self.mask_bytes = (len(self.actions) + 7) // 8
+        self.buffers = LRUCache(max_battles)
+        self.lock = threading.Lock()
+        self.shard = None
+        self.shard_size = 0
+
+    def encode(self, gamestate, battle_id):
+        if self.encoder is not None:
+            return self.encoder.encode_state(gamestate, battle_id)
+        return self.converter.encode_state(gamestate)
+
+    def legal_mask(self, legal_actions):
+        mask = np.zeros(len(self.actions), dtype=bool)
+        for action in legal_actions:
+            i = self.action_index.get(action_key(action))
+            if i is not None:
+                mask[i] = True
+        return np.packbits(mask)
+
+    def record(self, battle_id, gamestate, legal_actions, action, encoded=None):
+        """
+        Buffers one decision. encoded is the feature vector the agent already
+        computed for gamestate, if any; otherwise the state is encoded here.
+        """
+        if encoded is None:
+            encoded = self.encode(gamestate, battle_id)
+        buffer = self.buffers.get(battle_id)
+        if buffer is None:
+            buffer = TrajectoryBuffer(self.state_dim, self.mask_bytes, self.capacity, self.dtype)
+            self.buffers.put(battle_id, buffer)
+        index = -1 if action is None else self.action_index.get(action_key(action), -1)
+        buffer.append(encoded, self.legal_mask(legal_actions), index)
+
+    def discard(self, battle_id):
+        self.buffers.pop(battle_id)
+
+    def finish(self, battle_id, won):
+        """
+        Appends the battle to the current shard. won is True, False or None
+        for a tie or unknown result.
+        """
+        buffer = self.buffers.pop(battle_id)
+        if buffer is None or len(buffer) == 0:
+            return
+        order = buffer.order()
+        with self.lock:
+            if self.shard is None or self.shard_size >= self.shard_turns:
+                self.open_shard()
+            for name, array in ((STATES, buffer.states), (MASKS, buffer.masks), (ACTIONS, buffer.actions)):
+                with open(os.path.join(self.shard, name), 'ab') as fp:
+                    fp.write(array[order].tostring())
+            entry = {
+                'battle_id': battle_id,
+                'offset': self.shard_size,
+                'turns': len(order),
+                'truncated': buffer.count > buffer.capacity,
+                'outcome': OUTCOMES[won],
+            }
+            with open(os.path.join(self.shard, INDEX), 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+            self.shard_size += len(order)
+
+    def open_shard(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        # Several processes may write to one directory: os.mkdir fails on a
+        # name another one took first, so keep counting up until it succeeds.
+        index = len(glob.glob(os.path.join(self.directory, 'shard-*')))
+        while True:
+            self.shard = os.path.join(self.directory, 'shard-%05u' % index)
+            try:
+                os.mkdir(self.shard)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                index += 1
+        self.shard_size = 0
+        meta = {
+            'format': TRAJECTORY_FORMAT,
+            'state_dim': self.state_dim,
+            'state_dtype': self.dtype.str,
+            'n_actions': len(self.actions),
+            'actions': [str(action) for action in self.actions],
+        }
+        with open(os.path.join(self.shard, META), 'w') as fp:
+            json.dump(meta, fp, indent=2, sort_keys=True)
+        logging.info("Recording trajectories to %s" % self.shard)
+
+class TrajectoryShard(object):
+    """
+    Read-only view of one shard. Arrays are memory-mapped and cover only
+    the battles in the index, so a shard can be read while it is still
+    being written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as fp:
+            self.meta = json.load(fp)
+        if self.meta['format'] != TRAJECTORY_FORMAT:
+            raise ValueError("Unsupported trajectory format: %s" % self.meta['format'])
+        self.battles = []
+        with open(os.path.join(path, INDEX)) as fp:
+            for line in fp:
+                if line.endswith('\n'):
+                    self.battles.append(json.loads(line))
+        turns = sum(battle['turns'] for battle in self.battles)
+        n_actions = self.meta['n_actions']
+        self.states = self.map(STATES, self.meta['state_dtype'], (turns, self.meta['state_dim']))
+        self.masks = self.map(MASKS, np.uint8, (turns, (n_actions + 7) // 8))
+        self.actions = self.map(ACTIONS, ACTION_DTYPE, (turns,))
+        self.outcomes = np.repeat(np.array([battle['outcome'] for battle in self.battles], dtype=np.int8),
+                                  [battle['turns'] for battle in self.battles])
+
+    def map(self, name, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return len(self.battles)
+
+    def unpack_masks(self, masks):
+        return np.unpackbits(masks, axis=1)[:, :self.meta['n_actions']].astype(bool)
+
+    def battle(self, i):
+        """
+        Returns (states, masks, actions, outcome) for the i-th battle.
+        """
+        entry = self.battles[i]
+        turns = slice(entry['offset'], entry['offset'] + entry['turns'])
+        return (self.states[turns], self.unpack_masks(self.masks[turns]), self.actions[turns],
+                entry['outcome'])
+
+    def iter_batches(self, batch_size=1024):
+        """
+        Yields (states, masks, actions, outcomes) in chunks of batch_size
+        turns; only the current chunk is read into memory.
+        """
+        for start in xrange(0, len(self.actions), batch_size):
+            end = start + batch_size
+            yield (np.asarray(self.states[start:end], dtype=np.float32), self.unpack_masks(self.masks[start:end]),
+                   np.asarray(self.actions[start:end]), self.outcomes[start:end])
+
+def iter_shards(directory):
+    for path in sorted(glob.glob(os.path.join(directory, 'shard-*'))):
+        if os.path.isfile(os.path.join(path, INDEX)):
+            yield TrajectoryShard(path)